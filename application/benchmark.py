@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Reader throughput while writes are in flight, for each SQLite PRAGMA
+# profile of functions.SQLITE_PROFILES:
+#
+#     python benchmark.py [--seconds N] [--readers N] [--profile NAME]
+#
+# Each profile runs in its own process against a scratch copy of the
+# database, with one thread stopping and starting activities and the
+# readers calling getStatus and getLogsByDate.
+
+import sys, os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+curdir = os.path.abspath(os.path.dirname(__file__))
+if curdir not in sys.path:
+    sys.path.insert(0, curdir)
+
+import functions as server
+
+UID = 1
+ACTIVITY = 'test'
+
+def writer(stop, counts):
+    while not stop.isSet():
+        try:
+            server.stopActivity(uid=UID, descr=u'benchmark')
+            server.startActivity(uid=UID, name=ACTIVITY)
+            counts['writes'] += 1
+        except Exception:
+            counts['errors'] += 1
+
+def reader(stop, counts):
+    while not stop.isSet():
+        try:
+            server.getStatus(uid=UID)
+            server.getLogsByDate(uid=UID)
+            counts['reads'] += 1
+        except Exception:
+            counts['errors'] += 1
+
+def run(profile, seconds, readers):
+    workdir = tempfile.mkdtemp()
+    try:
+        server.DATABASE = os.path.join(workdir, 'timetracker.db')
+        if os.path.exists(os.path.join(curdir, 'timetracker.db')):
+            shutil.copy(os.path.join(curdir, 'timetracker.db'), server.DATABASE)
+        server.SQLITE_PROFILE = profile
+        server.setup()
+        # Close any activity left running in the copy before timing.
+        server.stopActivity(uid=UID, descr=u'benchmark')
+
+        stop = threading.Event()
+        counts = {'reads': 0, 'writes': 0, 'errors': 0}
+        threads = [threading.Thread(target=writer, args=(stop, counts))]
+        threads += [threading.Thread(target=reader, args=(stop, counts))
+                    for i in range(readers)]
+        for t in threads:
+            t.start()
+        time.sleep(seconds)
+        stop.set()
+        for t in threads:
+            t.join()
+        print "%-8s reads/s: %8.1f  writes/s: %6.1f  errors: %d" % (profile,
+            counts['reads'] / float(seconds), counts['writes'] / float(seconds),
+            counts['errors'])
+    finally:
+        server.engine.dispose()
+        shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-s", "--seconds", type="int", default=5,
+                      help="duration of each run (default: %default)")
+    parser.add_option("-r", "--readers", type="int", default=4,
+                      help="number of reader threads (default: %default)")
+    parser.add_option("-p", "--profile", default=None,
+                      help="profile to run (default: all, one process each)")
+    options, args = parser.parse_args()
+
+    if options.profile:
+        run(options.profile, options.seconds, options.readers)
+    else:
+        for profile in sorted(server.SQLITE_PROFILES):
+            subprocess.call([sys.executable, os.path.abspath(__file__),
+                             '--seconds', str(options.seconds),
+                             '--readers', str(options.readers),
+                             '--profile', profile])
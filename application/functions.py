@@ -2,7 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import os, sys
-from datetime import datetime
+import threading
+import hmac
+import hashlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
 import time
 try: 
    from hashlib import md5
@@ -19,21 +23,93 @@ if curdir not in sys.path:
     sys.path.insert(0, curdir)
 
 import simplejson as json
+import csv
+from cStringIO import StringIO
 
 DATABASE = os.path.join(curdir, 'timetracker.db')
 DEBUG = False
+# Connections kept open by the engine, shared by the server threads.
+POOL_SIZE = 5
+POOL_OVERFLOW = 10
+# Key signing the session tokens issued by authUser, created on first use.
+SECRET_FILE = os.path.join(curdir, 'secret.key')
+# Lifetime of a token in seconds, and of a verified token in the principal
+# cache, which holds at most PRINCIPAL_CACHE_SIZE tokens.
+TOKEN_TTL = 30 * 24 * 3600
+PRINCIPAL_CACHE_TTL = 300
+PRINCIPAL_CACHE_SIZE = 1000
+# Days an idempotency key is remembered, see rpccall.
+REQUEST_KEY_TTL = 7
+# PRAGMAs run on every new connection, by name of profile. 'wal' lets
+# readers proceed while a writer is committing.
+SQLITE_PROFILE = 'wal'
+SQLITE_PROFILES = {
+    'default': [],
+    'wal': [('journal_mode', 'WAL'),
+            ('synchronous', 'NORMAL'),
+            ('busy_timeout', 5000),
+            ('mmap_size', 64 * 1024 * 1024),
+            ('cache_size', -8000)],
+}
 
 from sqlalchemy import create_engine, func
-from sqlalchemy import Table, Column, Integer, Float, String, DateTime, MetaData, ForeignKey, Unicode, Boolean
-from sqlalchemy.sql.expression import and_, or_, between, asc
-from sqlalchemy.orm import sessionmaker, mapper, relation
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.interfaces import PoolListener
+from sqlalchemy import DDL, Index, Table, Column, Integer, Float, String, Date, DateTime, MetaData, ForeignKey, Unicode, Boolean
+from sqlalchemy.sql.expression import and_, or_, between, asc, select, cast
+from sqlalchemy.orm import scoped_session, sessionmaker, mapper, relation, class_mapper
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.orm.session import object_session
 
-if not os.path.exists(DATABASE):
-    mustReset = True
-else:
-    mustReset = False
+class SQLitePragmas(PoolListener):
+    """Apply a list of (name, value) PRAGMAs to each new connection."""
+    def __init__(self, pragmas):
+        self.pragmas = pragmas
+
+    def connect(self, dbapi_con, con_record):
+        for name, value in self.pragmas:
+            dbapi_con.execute('PRAGMA %s = %s' % (name, value))
+
+class PrincipalCache(object):
+    """Thread safe LRU map from session token to user id, whose entries
+    expire `ttl` seconds after being added."""
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, token):
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(token, None)
+            if entry is None or entry[1] < time.time():
+                return None
+            self.entries[token] = entry
+            return entry[0]
+        finally:
+            self.lock.release()
+
+    def add(self, token, uid):
+        self.lock.acquire()
+        try:
+            self.entries.pop(token, None)
+            self.entries[token] = (uid, time.time() + self.ttl)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def invalidate_user(self, uid):
+        self.lock.acquire()
+        try:
+            for token, entry in self.entries.items():
+                if entry[0] == uid:
+                    del self.entries[token]
+        finally:
+            self.lock.release()
+
+principals = PrincipalCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
 
 class BaseModel(object):
     def __new__(cls, *args, **kwargs):
@@ -59,12 +135,19 @@ class BaseModel(object):
     @classmethod
     def load(cls, session, **kwargs):
         q = session.query(cls)
+        primary_key = [c.key for c in class_mapper(cls).primary_key]
+        if kwargs.keys() == primary_key:
+            if kwargs[primary_key[0]] is None:
+                return None
+            # Served from the identity map when the object is already loaded.
+            return q.get(kwargs[primary_key[0]])
         filters = [getattr(cls, field_name)==kwargs[field_name] \
             for field_name in kwargs]
-        result = q.filter(and_(*filters))
-        if result.count() != 1:
+        # Two rows are enough to tell a unique match from an ambiguous one.
+        result = q.filter(and_(*filters)).limit(2).all()
+        if len(result) != 1:
             return None
-        return result.one()        
+        return result[0]
 
 class User(BaseModel):
     def __init__(self, name, password):
@@ -88,8 +171,6 @@ class ActivityLog(BaseModel):
     def __repr__(self):
         return '<ActivityLog %r>' % (self.activity.name)
 
-engine = create_engine('sqlite:///%s' % DATABASE, echo=DEBUG)
-
 metadata = MetaData()
 user_table = Table('user', metadata,
                        Column('id', Integer, primary_key=True),
@@ -108,38 +189,529 @@ activitylogs_table = Table('activitylog', metadata,
                        Column('user_id', Integer, ForeignKey('user.id')),                           
                        Column('activity_id', Integer, ForeignKey('activity.id')),
                        Column('description', Unicode),
-                       Column('date_start', DateTime, default=datetime.now()),                     
-                       Column('date_stop', DateTime, onupdate=datetime.now()),
-                       Column('is_completed', Boolean, default=False)
+                       Column('date_start', DateTime, default=datetime.now),
+                       Column('date_stop', DateTime, onupdate=datetime.now),
+                       Column('is_completed', Boolean, default=False),
+                       Column('version', Integer)
                      )
 
-mapper(User, user_table)
-mapper(Activity, activity_table, properties={
-            'user': relation(User, backref='activities'),
-            })
-mapper(ActivityLog, activitylogs_table, properties={
-            'activity': relation(Activity, backref='logs'),
-            'user': relation(User, backref='logs'),
-            })        
-metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-session = Session()
+# Deleted logs, kept so that clients can be told about them by getLogsSince.
+activitylog_deleted_table = Table('activitylog_deleted', metadata,
+                       Column('id', Integer, primary_key=True),
+                       Column('user_id', Integer),
+                       Column('version', Integer)
+                     )
+
+# Single row counter from which activitylog row versions are drawn.
+syncversion_table = Table('syncversion', metadata,
+                       Column('version', Integer, nullable=False)
+                     )
+
+# Latest syncversion at which each user's logs or activities changed, kept
+# by the triggers below; it tags the data read by the user's clients.
+userversion_table = Table('userversion', metadata,
+                       Column('user_id', Integer, primary_key=True),
+                       Column('version', Integer, nullable=False)
+                     )
+
+# Key of the rows of the tables below that belong to the logs without a user
+# (the GUI and the script send no uid): a NULL user_id would be given a rowid
+# of its own, or be refused by a composite primary key. User ids start at 1.
+NO_USER = 0
+
+def _user_key(uid):
+    return NO_USER if uid is None else uid
+
+# Tracked seconds per user, activity and day, kept current by the RPCs that
+# complete, edit or delete logs (see _add_to_totals). The day comes second
+# in the key, so that getSummary reads only the days of its range.
+dailytotal_table = Table('dailytotal', metadata,
+                       Column('user_id', Integer, primary_key=True),
+                       Column('day', Date, primary_key=True),
+                       Column('activity_id', Integer, primary_key=True),
+                       Column('seconds', Float, nullable=False, default=0)
+                     )
+
+# The running activity of each user, kept by startActivity and stopActivity
+# so that getStatus is a single primary key lookup.
+currentstatus_table = Table('currentstatus', metadata,
+                       Column('user_id', Integer, primary_key=True),
+                       Column('log_id', Integer, nullable=False),
+                       Column('activity_name', String(20)),
+                       Column('date_start', DateTime)
+                     )
+
+# Idempotency keys of the calls replayed by offline clients, with the
+# response of the call, which any replay of the key gets again.
+requestkey_table = Table('requestkey', metadata,
+                       Column('user_id', Integer, primary_key=True),
+                       Column('key', String(64), primary_key=True),
+                       Column('created', DateTime, nullable=False),
+                       Column('response', String)
+                     )
+
+# Secondary indexes, matching the Activity.load/ActivityLog.load lookups and
+# the aggregated log queries. (user_id, name) covers Activity lookups by name
+# since the rowid is part of every index.
+INDEXES = [
+    Index('ix_activity_user_name', activity_table.c.user_id, activity_table.c.name),
+    Index('ix_activitylog_user_completed', activitylogs_table.c.user_id,
+          activitylogs_table.c.is_completed),
+    Index('ix_activitylog_activity_start', activitylogs_table.c.activity_id,
+          activitylogs_table.c.is_completed, activitylogs_table.c.date_start),
+    Index('ix_activitylog_user_version', activitylogs_table.c.user_id,
+          activitylogs_table.c.version),
+    Index('ix_activitylog_deleted_user_version', activitylog_deleted_table.c.user_id,
+          activitylog_deleted_table.c.version),
+    Index('ix_requestkey_user_created', requestkey_table.c.user_id,
+          requestkey_table.c.created),
+]
+
+# Rows without a user are counted under NO_USER (0) in userversion.
+ACTIVITYLOG_TRIGGERS = [
+"""CREATE TRIGGER IF NOT EXISTS activitylog_version_insert AFTER INSERT ON activitylog
+BEGIN
+    UPDATE syncversion SET version = version + 1;
+    UPDATE activitylog SET version = (SELECT version FROM syncversion)
+        WHERE id = NEW.id;
+    INSERT OR REPLACE INTO userversion (user_id, version)
+        VALUES (coalesce(NEW.user_id, 0), (SELECT version FROM syncversion));
+    DELETE FROM activitylog_deleted WHERE id = NEW.id;
+END""",
+"""CREATE TRIGGER IF NOT EXISTS activitylog_version_update AFTER UPDATE ON activitylog
+WHEN NEW.version IS OLD.version
+BEGIN
+    UPDATE syncversion SET version = version + 1;
+    UPDATE activitylog SET version = (SELECT version FROM syncversion)
+        WHERE id = NEW.id;
+    INSERT OR REPLACE INTO userversion (user_id, version)
+        VALUES (coalesce(NEW.user_id, 0), (SELECT version FROM syncversion));
+END""",
+"""CREATE TRIGGER IF NOT EXISTS activitylog_version_delete AFTER DELETE ON activitylog
+BEGIN
+    UPDATE syncversion SET version = version + 1;
+    INSERT OR REPLACE INTO activitylog_deleted (id, user_id, version)
+        VALUES (OLD.id, OLD.user_id, (SELECT version FROM syncversion));
+    INSERT OR REPLACE INTO userversion (user_id, version)
+        VALUES (coalesce(OLD.user_id, 0), (SELECT version FROM syncversion));
+END""",
+]
+
+ACTIVITY_TRIGGERS = [
+"""CREATE TRIGGER IF NOT EXISTS activity_version_insert AFTER INSERT ON activity
+BEGIN
+    UPDATE syncversion SET version = version + 1;
+    INSERT OR REPLACE INTO userversion (user_id, version)
+        VALUES (coalesce(NEW.user_id, 0), (SELECT version FROM syncversion));
+END""",
+"""CREATE TRIGGER IF NOT EXISTS activity_version_update AFTER UPDATE ON activity
+BEGIN
+    UPDATE syncversion SET version = version + 1;
+    INSERT OR REPLACE INTO userversion (user_id, version)
+        VALUES (coalesce(NEW.user_id, 0), (SELECT version FROM syncversion));
+END""",
+"""CREATE TRIGGER IF NOT EXISTS activity_version_delete AFTER DELETE ON activity
+BEGIN
+    UPDATE syncversion SET version = version + 1;
+    INSERT OR REPLACE INTO userversion (user_id, version)
+        VALUES (coalesce(OLD.user_id, 0), (SELECT version FROM syncversion));
+END""",
+]
+for trigger in ACTIVITYLOG_TRIGGERS:
+    DDL(trigger).execute_at('after-create', activitylogs_table)
+for trigger in ACTIVITY_TRIGGERS:
+    DDL(trigger).execute_at('after-create', activity_table)
+DDL("INSERT INTO syncversion (version) VALUES (0)").execute_at('after-create', syncversion_table)
+
+def _migrate_row_versions(conn):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(activitylog)")]
+    if 'version' not in columns:
+        conn.execute("ALTER TABLE activitylog ADD COLUMN version INTEGER")
+    conn.execute("UPDATE activitylog SET version = id WHERE version IS NULL")
+    conn.execute("UPDATE syncversion SET version = "
+                 "max(version, (SELECT coalesce(max(version), 0) FROM activitylog))")
+    for trigger in ACTIVITYLOG_TRIGGERS:
+        conn.execute(trigger)
+
+def _migrate_indexes(conn):
+    # Tables added after the first release already got theirs from create_all.
+    existing = set(name for (name,) in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index'"))
+    for index in INDEXES:
+        if index.name not in existing:
+            index.create(bind=conn)
+    conn.execute("ANALYZE")
+
+def _migrate_daily_totals(conn):
+    _rebuild_daily_totals(conn)
+
+def _migrate_current_status(conn):
+    # Users with more than one running log had no status before either.
+    conn.execute("DELETE FROM currentstatus")
+    conn.execute("""INSERT INTO currentstatus (user_id, log_id, activity_name, date_start)
+        SELECT coalesce(activitylog.user_id, %d), activitylog.id, activity.name,
+            activitylog.date_start
+        FROM activitylog JOIN activity ON activity.id = activitylog.activity_id
+        WHERE activitylog.is_completed = 0
+        GROUP BY coalesce(activitylog.user_id, %d) HAVING count(*) = 1""" % (NO_USER, NO_USER))
+
+def _migrate_user_versions(conn):
+    for name in ('activitylog_version_insert', 'activitylog_version_update',
+                 'activitylog_version_delete'):
+        conn.execute("DROP TRIGGER IF EXISTS %s" % name)
+    for trigger in ACTIVITYLOG_TRIGGERS + ACTIVITY_TRIGGERS:
+        conn.execute(trigger)
+    conn.execute("""INSERT OR REPLACE INTO userversion (user_id, version)
+        SELECT user_id, max(version) FROM
+            (SELECT user_id, version FROM activitylog
+             UNION ALL SELECT user_id, version FROM activitylog_deleted)
+        WHERE user_id IS NOT NULL GROUP BY user_id""")
+
+def _migrate_request_keys(conn):
+    # A new table, already made by create_all.
+    pass
+
+def _migrate_status_keys(conn):
+    # The status of the logs without a user was stored under a new rowid.
+    _migrate_current_status(conn)
+
+def _migrate_version_keys(conn):
+    # The triggers stored the version of rows without a user under a new
+    # rowid each time. The versions lost with them are replaced by a new
+    # one for every user, so that no client keeps a stale ETag.
+    for table in ('activitylog', 'activity'):
+        for event in ('insert', 'update', 'delete'):
+            conn.execute("DROP TRIGGER IF EXISTS %s_version_%s" % (table, event))
+    for trigger in ACTIVITYLOG_TRIGGERS + ACTIVITY_TRIGGERS:
+        conn.execute(trigger)
+    conn.execute("DELETE FROM userversion")
+    conn.execute("UPDATE syncversion SET version = version + 1")
+    conn.execute("""INSERT INTO userversion (user_id, version)
+        SELECT coalesce(user_id, %d), (SELECT version FROM syncversion) FROM
+            (SELECT user_id FROM activitylog
+             UNION SELECT user_id FROM activitylog_deleted
+             UNION SELECT user_id FROM activity)
+        GROUP BY coalesce(user_id, %d)""" % (NO_USER, NO_USER))
+
+def _migrate_daily_total_key(conn):
+    # SQLite cannot change a primary key in place.
+    conn.execute("ALTER TABLE dailytotal RENAME TO dailytotal_old")
+    dailytotal_table.create(bind=conn)
+    conn.execute("""INSERT INTO dailytotal (user_id, day, activity_id, seconds)
+        SELECT user_id, day, activity_id, seconds FROM dailytotal_old""")
+    conn.execute("DROP TABLE dailytotal_old")
+
+# Schema upgrades for databases created by older releases, in order. The
+# position of a step in the list (1-based) is the schema version it brings
+# the database to, as recorded in PRAGMA user_version.
+MIGRATIONS = [
+    _migrate_row_versions,
+    _migrate_indexes,
+    _migrate_daily_totals,
+    _migrate_current_status,
+    _migrate_user_versions,
+    _migrate_request_keys,
+    _migrate_status_keys,
+    _migrate_version_keys,
+    _migrate_daily_total_key,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def _exclusive(conn, step):
+    """Run step(conn) in an exclusive transaction. pysqlite would commit
+    on its own before each DDL statement, so it is put in autocommit mode
+    and the transaction is spelled out."""
+    raw = conn.connection.connection
+    isolation_level = raw.isolation_level
+    raw.isolation_level = None
+    trans = conn.begin()
+    try:
+        conn.execute("BEGIN EXCLUSIVE")
+        try:
+            step(conn)
+        except:
+            exc_info = sys.exc_info()
+            try:
+                conn.execute("ROLLBACK")
+            except Exception:
+                # SQLite may have rolled back already.
+                pass
+            raise exc_info[0], exc_info[1], exc_info[2]
+        conn.execute("COMMIT")
+    finally:
+        trans.commit()
+        raw.isolation_level = isolation_level
+
+def _migrate_step(conn):
+    # Read again under the lock: a concurrent process may have upgraded.
+    current = conn.execute("PRAGMA user_version").scalar()
+    if current >= SCHEMA_VERSION:
+        return
+    empty = not conn.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table'").scalar()
+    metadata.create_all(conn)
+    if empty:
+        # A new database is created with the current schema.
+        current = SCHEMA_VERSION
+    else:
+        MIGRATIONS[current](conn)
+        current += 1
+    conn.execute("PRAGMA user_version = %d" % current)
+
+def migrate(engine):
+    """Bring the database schema up to SCHEMA_VERSION. Each step runs in
+    an exclusive transaction with its PRAGMA user_version stamp, so that
+    an interrupted or concurrent upgrade resumes where it stopped; the
+    steps also check the schema, and can run again on a database that
+    already has their changes."""
+    conn = engine.connect()
+    try:
+        while conn.execute("PRAGMA user_version").scalar() < SCHEMA_VERSION:
+            _exclusive(conn, _migrate_step)
+    finally:
+        conn.close()
+
+# Engine, mappers and session are set up by the first RPC, see setup().
+engine = None
+session = None
+_setup_lock = threading.Lock()
+
+_mapped = False
+
+def _map_classes():
+    global _mapped
+    if _mapped:
+        return
+    mapper(User, user_table)
+    mapper(Activity, activity_table, properties={
+                'user': relation(User, backref='activities'),
+                })
+    mapper(ActivityLog, activitylogs_table, properties={
+                'activity': relation(Activity, backref='logs'),
+                'user': relation(User, backref='logs'),
+                })
+    _mapped = True
+
+def setup():
+    global engine, session
+    if session is not None:
+        return
+    _setup_lock.acquire()
+    try:
+        if session is not None:
+            return
+        _map_classes()
+        # A QueuePool hands each connection to one thread at a time, so
+        # pysqlite's same-thread check can be lifted.
+        engine = create_engine('sqlite:///%s' % DATABASE, echo=DEBUG,
+                               poolclass=QueuePool, pool_size=POOL_SIZE,
+                               max_overflow=POOL_OVERFLOW,
+                               connect_args={'check_same_thread': False},
+                               listeners=[SQLitePragmas(SQLITE_PROFILES[SQLITE_PROFILE])])
+        try:
+            migrate(engine)
+        except:
+            # e.g. the database locked by another process upgrading it: the
+            # next RPC tries again.
+            engine.dispose()
+            engine = None
+            raise
+        # One session per thread, released at the end of each request.
+        session = scoped_session(sessionmaker(bind=engine))
+    finally:
+        _setup_lock.release()
+
+# Per thread request state: `depth` counts the rpccalls and batches being
+# run, the session is released when the outermost one returns; while
+# `batch_depth` is positive commits are deferred to the end of the batch so
+# that all of its calls share one transaction.
+_request = threading.local()
+
+def _enter():
+    _request.depth = getattr(_request, 'depth', 0) + 1
+
+def _leave():
+    _request.depth -= 1
+    if not _request.depth:
+        end_request()
+
+def commit():
+    if getattr(_request, 'batch_depth', 0):
+        session.flush()
+    else:
+        session.commit()
+
+def end_request():
+    """Release the connection and the objects loaded by the current
+    request, so that a long-lived server starts each one afresh."""
+    if session is not None:
+        session.remove()
+
+_secret = None
+_compare_digest = getattr(hmac, 'compare_digest', lambda a, b: a == b)
+
+def _secret_key():
+    global _secret
+    if _secret is None:
+        if not os.path.exists(SECRET_FILE):
+            f = open(SECRET_FILE, 'wb')
+            try:
+                f.write(os.urandom(32).encode('hex'))
+            finally:
+                f.close()
+        _secret = open(SECRET_FILE, 'rb').read().strip()
+    return _secret
+
+def _sign(uid, expires, password):
+    # The password is part of the signature: changing it revokes the tokens.
+    message = '%s.%s.%s' % (uid, expires, (password or '').encode('utf-8'))
+    return hmac.new(_secret_key(), message, hashlib.sha1).hexdigest()
+
+def issue_token(user):
+    expires = int(time.time()) + TOKEN_TTL
+    token = '%d.%d.%s' % (user.id, expires, _sign(user.id, expires, user.password))
+    principals.add(token, user.id)
+    return token
+
+def token_user(token):
+    """Return the id of the user a token was issued to, or None when the
+    token is invalid or expired. Cached tokens need no database access."""
+    uid = principals.get(token)
+    if uid is not None:
+        return uid
+    try:
+        uid, expires, signature = str(token).split('.')
+        uid, expires = int(uid), int(expires)
+    except (ValueError, UnicodeError):
+        return None
+    if expires < time.time():
+        return None
+    user = User.load(session, id=uid)
+    if not user or not _compare_digest(_sign(uid, expires, user.password), signature):
+        return None
+    principals.add(token, uid)
+    return uid
 
-    
 def rpccall(func):
     METHODS.append(func.__name__)
     def wrapper(**kwargs):
-        id = kwargs.pop('id', 0)
-        error = False
-        result = func(**kwargs)
-        if type(result) in [str, unicode]:
-          result = str(data)
-        elif type(result) == dict:
-            if 'error' in result:
-                error = result.pop('error')
-        return {'id': id, 'result': result, 'error': error}
+        setup()
+        _enter()
+        try:
+            id = kwargs.pop('id', 0)
+            if 'token' in kwargs:
+                uid = token_user(kwargs.pop('token'))
+                if uid is None:
+                    return {'id': id, 'result': {'msg': 'Invalid token'}, 'error': True}
+                kwargs['uid'] = uid
+            key = kwargs.pop('idempotency_key', None)
+            if key is not None:
+                response = _replayed_response(kwargs.get('uid'), key)
+                if response is not None:
+                    response['id'] = id
+                    return response
+            error = False
+            result = func(**kwargs)
+            if type(result) in [str, unicode]:
+              result = str(data)
+            elif type(result) == dict:
+                if 'error' in result:
+                    error = result.pop('error')
+            response = {'id': id, 'result': result, 'error': error}
+            if key is not None and not error:
+                _store_response(kwargs.get('uid'), key, response)
+            return response
+        finally:
+            _leave()
     return wrapper
 
+def _replayed_response(uid, key):
+    """Return the response already given to the idempotency key, or None
+    after reserving the key for the call about to run: the reservation is
+    committed along with the call's changes, or rolled back with them."""
+    t = requestkey_table.c
+    uid = _user_key(uid)
+    row = session.execute(select([t.response], and_(t.user_id==uid, t.key==key))).first()
+    if row:
+        if row.response is None:
+            return {'result': {'msg': 'Already applied'}, 'error': False}
+        return json.loads(row.response)
+    now = datetime.now()
+    session.execute(requestkey_table.delete(
+        and_(t.user_id==uid, t.created < now - timedelta(days=REQUEST_KEY_TTL))))
+    session.execute(requestkey_table.insert(),
+                    {'user_id': uid, 'key': key, 'created': now})
+    return None
+
+def _store_response(uid, key, response):
+    t = requestkey_table.c
+    session.execute(requestkey_table.update(and_(t.user_id==_user_key(uid), t.key==key)),
+                    {'response': json.dumps(response)})
+    commit()
+
+def _split_days(start, stop):
+    """Yield (day, seconds) for each day spanned by the interval."""
+    while start.date() < stop.date():
+        midnight = datetime.combine(start.date() + timedelta(days=1), datetime.min.time())
+        yield start.date(), _seconds(midnight - start)
+        start = midnight
+    if stop > start:
+        yield start.date(), _seconds(stop - start)
+
+def _seconds(delta):
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+def _totals_of(logs, sign=1):
+    """Sum the seconds of completed logs, given as (user_id, activity_id,
+    date_start, date_stop) tuples, per (user_id, activity_id, day)."""
+    totals = {}
+    for user_id, activity_id, date_start, date_stop in logs:
+        for day, seconds in _split_days(date_start, date_stop):
+            key = (_user_key(user_id), activity_id, day)
+            totals[key] = totals.get(key, 0) + sign * seconds
+    return totals
+
+def _apply_totals(totals):
+    """Add a _totals_of() dict to the daily totals, in the current
+    transaction."""
+    t = dailytotal_table.c
+    for (user_id, activity_id, day), seconds in totals.items():
+        key = and_(t.user_id==user_id, t.activity_id==activity_id, t.day==day)
+        result = session.execute(dailytotal_table.update(key,
+                                 values={t.seconds: t.seconds + seconds}))
+        if not result.rowcount:
+            session.execute(dailytotal_table.insert(),
+                            {'user_id': user_id, 'activity_id': activity_id,
+                             'day': day, 'seconds': seconds})
+        elif seconds < 0:
+            # Drop days left empty, allowing for float rounding.
+            session.execute(dailytotal_table.delete(and_(key, t.seconds < 0.001)))
+
+def _add_to_totals(log, sign=1):
+    """Add (sign=1) or remove (sign=-1) a completed log from the daily
+    totals, in the current transaction."""
+    if not log.is_completed or not log.date_start or not log.date_stop:
+        return
+    _apply_totals(_totals_of([(log.user_id, log.activity_id,
+                               log.date_start, log.date_stop)], sign))
+
+def _rebuild_daily_totals(conn):
+    """Recompute the daily totals from scratch over the whole history."""
+    log = activitylogs_table.c
+    q = select([log.user_id, log.activity_id, log.date_start, log.date_stop],
+               and_(log.is_completed==True, log.date_start!=None, log.date_stop!=None))
+    totals = _totals_of(conn.execute(q))
+    conn.execute(dailytotal_table.delete())
+    if totals:
+        conn.execute(dailytotal_table.insert(),
+                     [{'user_id': user_id, 'activity_id': activity_id,
+                       'day': day, 'seconds': seconds}
+                      for (user_id, activity_id, day), seconds in totals.items()])
+
+def rebuildDailyTotals():
+    setup()
+    _rebuild_daily_totals(session)
+    commit()
+
 @rpccall
 def addUser(**kwargs):
     uname = kwargs.get('uname')
@@ -149,7 +721,8 @@ def addUser(**kwargs):
         return {'msg':'User already exists!', 'error': True}
     newuser = User(uname, pwd)
     newuser.save()
-    session.commit()
+    commit()
+    principals.invalidate_user(newuser.id)
     return {'uid': newuser.id, 'error': False}
 
 @rpccall
@@ -159,18 +732,45 @@ def authUser(**kwargs):
     u = User.load(session, name=uname)
     if u:
         if u.password == pwd:
-            return {'uid': u.id, 'error': False}
+            return {'uid': u.id, 'token': issue_token(u), 'error': False}
         else:
             return {'msg':'Password do not match!', 'error': True}            
     return {'msg':'User do not exist!', 'error': True}
 
+@rpccall
+def changePassword(**kwargs):
+    uid = kwargs.get('uid')
+    u = User.load(session, id=uid)
+    if u and u.password == kwargs.get('pwd'):
+        u.password = kwargs.get('newpwd')
+        commit()
+        principals.invalidate_user(u.id)
+        return {'uid': u.id, 'token': issue_token(u), 'error': False}
+    return {'msg':'Password do not match!', 'error': True}
+
+def _set_status(log, name):
+    """Record `log` as the running activity of its user, or clear the
+    user's status when name is None, in the current transaction."""
+    if name is None:
+        session.execute(currentstatus_table.delete(
+            currentstatus_table.c.user_id==_user_key(log.user_id)))
+    else:
+        session.execute(currentstatus_table.insert(prefixes=['OR REPLACE']),
+                        {'user_id': _user_key(log.user_id), 'log_id': log.id,
+                         'activity_name': name, 'date_start': log.date_start})
+
+def _current_status(uid):
+    t = currentstatus_table.c
+    return session.execute(select([t.log_id, t.activity_name, t.date_start],
+                                  t.user_id==_user_key(uid))).first()
+
 @rpccall
 def getStatus(**kwargs):
     uid = kwargs.get('uid')   
-    act = ActivityLog.load(session, user_id=uid, is_completed=False)
-    if act:
-        return {'name': act.activity.name,
-                'start': act.date_start.strftime("%d/%m/%Y %H:%M:%S"),
+    status = _current_status(uid)
+    if status:
+        return {'name': status.activity_name,
+                'start': status.date_start.strftime("%d/%m/%Y %H:%M:%S"),
                 'current': datetime.now().strftime("%d/%m/%Y %H:%M:%S")
                 }
     return {'name':'none', 'start':''}
@@ -178,10 +778,9 @@ def getStatus(**kwargs):
 @rpccall
 def getActivities(**kwargs):
     uid = kwargs.get('uid')
-    user = User.load(session, id=uid)
-    if not user:
-       return []
-    return [a.name for a in user.activities]
+    act = activity_table.c
+    q = select([act.name], act.user_id==uid).order_by(act.id)
+    return [row.name for row in session.execute(q)]
 
 @rpccall
 def getItem(**kwargs):
@@ -207,12 +806,17 @@ def editItem(**kwargs):
     act = ActivityLog.load(session, user_id=uid, id=itemId)
     if act:
         att = Activity.load(session, user_id=uid, name=name)
+        _add_to_totals(act, -1)
         act.activity_id = att.id
         act.description = kwargs['description']
         act.date_start = datetime(*(time.strptime(kwargs['date_start'], "%d/%m/%Y %H:%M:%S")[0:6]))
         act.date_stop = datetime(*(time.strptime(kwargs['date_stop'], "%d/%m/%Y %H:%M:%S")[0:6]))
         act.save()
-        session.commit()
+        _add_to_totals(act)
+        status = _current_status(act.user_id)
+        if status and status.log_id == act.id:
+            _set_status(act, att.name)
+        commit()
         return {'msg':'Item modified', 'error': False}
     return {'msg':'Error occurred', 'error': True}
 
@@ -222,11 +826,118 @@ def deleteItem(**kwargs):
     itemId = kwargs.get('index')
     act = ActivityLog.load(session, user_id=uid, id=itemId)
     if act:
+        _add_to_totals(act, -1)
+        status = _current_status(act.user_id)
+        if status and status.log_id == act.id:
+            _set_status(act, None)
         act.drop()
-        session.commit()        
+        commit()
         return {'msg':'Item deleted', 'error': False}
     return {'msg':'Error occurred', 'error': True}
 
+def _id_list(value):
+    """Return a list of ids from a list, its JSON encoding or a single id."""
+    if isinstance(value, basestring):
+        if value.startswith('['):
+            value = json.loads(value)
+        else:
+            value = value.split(',')
+    elif not isinstance(value, (list, tuple)):
+        value = [value]
+    return [int(v) for v in value]
+
+def _completed_intervals(uid, ids):
+    log = activitylogs_table.c
+    return session.execute(select([log.user_id, log.activity_id, log.date_start, log.date_stop],
+                                  and_(log.user_id==uid, log.id.in_(ids),
+                                       log.is_completed==True))).fetchall()
+
+@rpccall
+def deleteItems(**kwargs):
+    """Delete the logs listed in `indices` with a single DELETE."""
+    uid = kwargs.get('uid')
+    try:
+        ids = _id_list(kwargs.get('indices') or [])
+    except ValueError:
+        return {'msg':'Invalid indices', 'error': True}
+    if not ids:
+        return {'msg':'0 items deleted', 'deleted': 0, 'error': False}
+    _apply_totals(_totals_of(_completed_intervals(uid, ids), -1))
+    status = _current_status(uid)
+    if status and status.log_id in ids:
+        session.execute(currentstatus_table.delete(
+            currentstatus_table.c.user_id==_user_key(uid)))
+    count = session.query(ActivityLog) \
+        .filter(and_(ActivityLog.user_id==uid, ActivityLog.id.in_(ids))) \
+        .delete(synchronize_session='fetch')
+    commit()
+    return {'msg':'%d items deleted' % count, 'deleted': count, 'error': False}
+
+@rpccall
+def editItems(**kwargs):
+    """Apply a list (or its JSON encoding) of changes, dicts holding an
+    `index` and any of activity_name, description, date_start, date_stop.
+    Changes setting the same values are applied with a single UPDATE.
+    Invalid changes are skipped and reported by position in 'errors'."""
+    uid = kwargs.get('uid')
+    changes = kwargs.get('changes') or []
+    if isinstance(changes, basestring):
+        changes = json.loads(changes)
+    act = activity_table.c
+    activities = dict(session.execute(select([act.name, act.id], act.user_id==uid)).fetchall())
+
+    groups = {}
+    errors = []
+    for i, change in enumerate(changes):
+        try:
+            index = int(change['index'])
+            values = {}
+            if 'activity_name' in change:
+                if change['activity_name'] not in activities:
+                    raise ValueError('unknown activity %s' % change['activity_name'])
+                values['activity_id'] = activities[change['activity_name']]
+            if 'description' in change:
+                values['description'] = _unicode(change['description'] or u'')
+            for name in ('date_start', 'date_stop'):
+                if name in change:
+                    values[name] = _parse_datetime(change[name])
+        except (KeyError, TypeError, ValueError), e:
+            errors.append({'row': i, 'msg': 'Invalid change: %s' % e})
+            continue
+        if values:
+            groups.setdefault(tuple(sorted(values.items())), []).append(index)
+
+    ids = sum(groups.values(), [])
+    if not ids:
+        return {'msg':'0 items modified', 'modified': 0, 'errors': errors, 'error': False}
+    totals = _totals_of(_completed_intervals(uid, ids), -1)
+    count = 0
+    for values, group in groups.items():
+        values = dict(values)
+        # Without an explicit value the onupdate default would stamp now().
+        values.setdefault('date_stop', activitylogs_table.c.date_stop)
+        count += session.query(ActivityLog) \
+            .filter(and_(ActivityLog.user_id==uid, ActivityLog.id.in_(group))) \
+            .update(values, synchronize_session='fetch')
+    for key, seconds in _totals_of(_completed_intervals(uid, ids)).items():
+        totals[key] = totals.get(key, 0) + seconds
+    _apply_totals(dict([(key, seconds) for key, seconds in totals.items()
+                        if abs(seconds) >= 0.001]))
+    status = _current_status(uid)
+    if status and status.log_id in ids:
+        log = ActivityLog.load(session, id=status.log_id)
+        _set_status(log, log.activity.name)
+    commit()
+    return {'msg':'%d items modified' % count, 'modified': count, 'errors': errors,
+            'error': False}
+
+def _action_time(kwargs):
+    """Time of a start or stop: the `at` parameter of calls queued by an
+    offline client, else now."""
+    if kwargs.get('at'):
+        return _parse_datetime(kwargs['at'])
+    return datetime.now()
+
 @rpccall
 def startActivity(**kwargs):
     uid = kwargs.get('uid')
@@ -234,12 +945,15 @@ def startActivity(**kwargs):
     activity = Activity.load(session, user_id=uid, name=name)
     if not activity:
         activity = Activity(name)
-        user.activities.append(activity)
-        user.save()
+        activity.user_id = uid
+        activity.save()
     job = ActivityLog(activity)
     job.user_id = uid
+    job.date_start = _action_time(kwargs)
     job.save()
-    session.commit()
+    session.flush()
+    _set_status(job, activity.name)
+    commit()
     status = getStatus(**kwargs)
     return {'msg':'Activity %s started!' % kwargs['name'],
             'status': status}
@@ -249,72 +963,380 @@ def startActivity(**kwargs):
 def stopActivity(**kwargs):
     uid = kwargs.get('uid')
     descr = kwargs.get('descr', '')
-    act = ActivityLog.load(session, user_id=uid, is_completed=False)
+    status = _current_status(uid)
+    act = status and ActivityLog.load(session, id=status.log_id)
     if act:
         act.is_completed = True
         act.description = descr
-        session.commit()
+        act.date_stop = _action_time(kwargs)
+        _add_to_totals(act)
+        _set_status(act, None)
+        commit()
         status = getStatus(**kwargs)
         return {'id': act.id, 'msg':'Activity %s (%s) stopped!' % (act.activity.name, descr),
                 'status': status}
     status = getStatus(**kwargs)
     return {'msg':'Error occurred', 'status': status, 'error': True}
     
+def _parse_date(value):
+    if not value:
+        return None
+    return datetime(*(time.strptime(value, "%d/%m/%Y")[0:3]))
+
+def _invalid_dates(kwargs):
+    """Return the error of a call whose from or to is not a dd/mm/yyyy
+    date, or None."""
+    try:
+        for name in ('from', 'to'):
+            _parse_date(kwargs.get(name))
+    except (TypeError, ValueError):
+        return {'msg': 'Invalid date', 'error': True}
+    return None
+
+def _format_duration(seconds):
+    return str(timedelta(seconds=int(seconds or 0)))
+
+def _duration_seconds(log):
+    # Whole seconds, truncated like str(timedelta) after dropping the
+    # microseconds; julianday() is exact to the millisecond.
+    return cast(func.round((func.julianday(log.date_stop) -
+                            func.julianday(log.date_start)) * 86400000),
+                Integer) / 1000
+
+def _completed_logs(uid, date_from=None, date_to=None, versions=None):
+    """Return the completed logs of a user as flat rows, bucketed by date
+    and with durations computed by SQLite, ordered by start date.
+
+    `versions` is an optional (after, upto) pair restricting the result to
+    the rows changed in that version range."""
+    log = activitylogs_table.c
+    act = activity_table.c
+    filters = [act.user_id==uid, log.is_completed==True]
+    if versions:
+        # On the log's own user_id, so that ix_activitylog_user_version
+        # reads only the changed rows.
+        filters.append(log.user_id==uid)
+        filters.append(between(log.version, versions[0] + 1, versions[1]))
+    if date_from:
+        filters.append(log.date_start >= _parse_date(date_from))
+    if date_to:
+        filters.append(log.date_start < _parse_date(date_to) + timedelta(days=1))
+    q = select([log.id, log.description, act.name,
+                func.strftime('%d/%m/%Y', log.date_start).label('date'),
+                func.strftime('%H:%M', log.date_start).label('time_start'),
+                func.strftime('%H:%M', log.date_stop).label('time_stop'),
+                cast(func.strftime('%s', log.date_start), Integer).label('start'),
+                _duration_seconds(log).label('seconds')],
+               and_(*filters),
+               from_obj=[activitylogs_table.join(activity_table,
+                                                 log.activity_id==act.id)]
+               ).order_by(log.date_start)
+    return session.execute(q)
+
+def _log_entry(row):
+    return (row.id, row.description, _format_duration(row.seconds),
+            row.time_start, row.time_stop)
+
+def _columnar(rows):
+    """Return logs as parallel arrays: activities index into names, starts
+    are the local start times in seconds since the epoch, read as UTC."""
+    names, indexes = [], {}
+    ret = {'names': names, 'ids': [], 'activities': [], 'starts': [],
+           'durations': [], 'descriptions': []}
+    for row in rows:
+        if row.name not in indexes:
+            indexes[row.name] = len(names)
+            names.append(row.name)
+        ret['ids'].append(row.id)
+        ret['activities'].append(indexes[row.name])
+        ret['starts'].append(row.start)
+        ret['durations'].append(row.seconds)
+        ret['descriptions'].append(row.description)
+    return ret
+
+IMPORT_COLUMNS = ['activity_name', 'description', 'date_start', 'date_stop']
+
+def _unicode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+def _parse_datetime(value):
+    return datetime(*(time.strptime(value, "%d/%m/%Y %H:%M:%S")[0:6]))
+
+@rpccall
+def importLogs(**kwargs):
+    """Insert completed logs in bulk, in one transaction. `rows` is a list
+    (or its JSON encoding) of dicts with the IMPORT_COLUMNS keys, or of
+    lists in that order; activities are created as needed. Invalid rows
+    are skipped and reported by index in 'errors'."""
+    uid = kwargs.get('uid')
+    rows = kwargs.get('rows') or []
+    if isinstance(rows, basestring):
+        rows = json.loads(rows)
+    errors = []
+    logs = []
+    for i, row in enumerate(rows):
+        try:
+            if not isinstance(row, dict):
+                row = dict(zip(IMPORT_COLUMNS, row))
+            log = {'name': row['activity_name'],
+                   'description': _unicode(row.get('description') or u''),
+                   'date_start': _parse_datetime(row['date_start']),
+                   'date_stop': _parse_datetime(row['date_stop'])}
+        except (KeyError, TypeError, ValueError), e:
+            errors.append({'row': i, 'msg': 'Invalid row: %s' % e})
+            continue
+        if not log['name'] or log['date_stop'] < log['date_start']:
+            errors.append({'row': i, 'msg': 'Missing activity or negative duration'})
+            continue
+        logs.append((i, log))
+
+    act = activity_table.c
+    activities = dict(session.execute(select([act.name, act.id], act.user_id==uid)).fetchall())
+    missing = set([log['name'] for i, log in logs]) - set(activities)
+    if missing:
+        # Names are unique across users: those taken by somebody else are
+        # ignored here and reported below.
+        session.execute(activity_table.insert(prefixes=['OR IGNORE']),
+                        [{'user_id': uid, 'name': name} for name in missing])
+        activities = dict(session.execute(select([act.name, act.id], act.user_id==uid)).fetchall())
+
+    values = []
+    for i, log in logs:
+        if log['name'] not in activities:
+            errors.append({'row': i, 'msg': 'Activity %s not available' % log['name']})
+            continue
+        values.append({'user_id': uid, 'activity_id': activities[log['name']],
+                       'description': log['description'], 'is_completed': True,
+                       'date_start': log['date_start'], 'date_stop': log['date_stop']})
+    if values:
+        session.execute(activitylogs_table.insert(), values)
+        _apply_totals(_totals_of([(v['user_id'], v['activity_id'], v['date_start'],
+                                   v['date_stop']) for v in values]))
+    commit()
+    return {'imported': len(values), 'errors': errors}
+
 @rpccall
 def getLogs(**kwargs):
-    ret = {}   
+    ret = {}
     uid = kwargs.get('uid')
-    user = User.load(session, id=uid)
-    if not user:
-        return ret
-      
-    for a in user.activities:
-        logs = {}
-        for log in a.logs:
-            if not log.is_completed:
-                continue
-            
-            date = log.date_start.strftime("%d/%m/%Y")
-            time_start = log.date_start.strftime("%H:%M")
-            time_stop = log.date_stop.strftime("%H:%M")            
-            delta = (log.id, log.description , str(log.date_stop - log.date_start).split(".")[0], time_start, time_stop)
-            
-            if logs.has_key(date):
-                logs[date].append(delta)
-            else:
-                logs[date] = [delta]
-        ret[a.name] = logs
+    error = _invalid_dates(kwargs)
+    if error:
+        return error
+    rows = _completed_logs(uid, kwargs.get('from'), kwargs.get('to'))
+    if kwargs.get('format') == 'columnar':
+        return _columnar(rows)
+    for row in rows:
+        ret.setdefault(row.name, {}).setdefault(row.date, []).append(_log_entry(row))
     return ret
 
 @rpccall
 def getLogsByDate(**kwargs):
     ret = {}
     uid = kwargs.get('uid')
-    user = User.load(session, id=uid)
-    if not user:
-        return ret
-
-    for a in user.activities:
-        logs = {}
-        for log in a.logs:
-            if not log.is_completed:
-                continue
-            date = log.date_start.strftime("%d/%m/%Y")
-            time_start = log.date_start.strftime("%H:%M")
-            time_stop = log.date_stop.strftime("%H:%M")            
-            delta = (log.id, log.description , str(log.date_stop - log.date_start).split(".")[0], time_start, time_stop)
-            if not ret.has_key(date):
-                ret[date] = {}
-            if not ret[date].has_key(a.name):
-                ret[date][a.name] = [delta]
-            else:
-                ret[date][a.name].append(delta)
+    error = _invalid_dates(kwargs)
+    if error:
+        return error
+    rows = _completed_logs(uid, kwargs.get('from'), kwargs.get('to'))
+    if kwargs.get('format') == 'columnar':
+        return _columnar(rows)
+    for row in rows:
+        ret.setdefault(row.date, {}).setdefault(row.name, []).append(_log_entry(row))
     return ret
 
+def _current_version():
+    return session.execute(select([syncversion_table.c.version])).scalar()
+
+# Read RPCs whose result only depends on their parameters and on the user's
+# data version, so that an unchanged version means an unchanged result.
+CONDITIONAL_METHODS = ['getActivities', 'getLogs', 'getLogsByDate',
+                       'getLogsSince', 'getSummary']
+
+def request_user(kwargs):
+    """Return the id of the user a call is made for, from its token or
+    uid parameter, or None."""
+    setup()
+    if 'token' in kwargs:
+        return token_user(kwargs['token'])
+    try:
+        return int(kwargs.get('uid'))
+    except (TypeError, ValueError):
+        return None
+
+def data_version(uid):
+    """Return the version of a user's logs and activities, which grows
+    with every change to them."""
+    setup()
+    t = userversion_table.c
+    return session.execute(select([t.version], t.user_id==_user_key(uid))).scalar() or 0
+
+def data_versions(uids):
+    """Return a {uid: version} dict for several users in one query."""
+    setup()
+    t = userversion_table.c
+    keys = dict([(uid, _user_key(uid)) for uid in uids])
+    versions = dict(session.execute(select([t.user_id, t.version],
+                                           t.user_id.in_(keys.values()))).fetchall())
+    return dict([(uid, versions.get(key, 0)) for uid, key in keys.items()])
+
+def _parse_cursor(cursor):
+    try:
+        return int(cursor or 0, 16)
+    except (TypeError, ValueError):
+        return 0
+
+@rpccall
+def getLogsSince(**kwargs):
+    """Return the logs changed since `cursor`, as returned by a previous
+    call, together with the ids of the deleted ones and a new cursor. An
+    empty cursor returns every log. Like getLogs and getLogsByDate it
+    accepts format=columnar."""
+    uid = kwargs.get('uid')
+    since = _parse_cursor(kwargs.get('cursor'))
+    upto = _current_version()
+    rows = _completed_logs(uid, versions=(since, upto))
+    if kwargs.get('format') == 'columnar':
+        logs = _columnar(rows)
+    else:
+        logs = [(row.id, row.name, row.date) + _log_entry(row)[1:] for row in rows]
+    deleted = activitylog_deleted_table.c
+    q = select([deleted.id], and_(deleted.user_id==uid,
+                                  between(deleted.version, since + 1, upto)))
+    return {'cursor': '%x' % upto,
+            'logs': logs,
+            'deleted': [row.id for row in session.execute(q)]}
+
+# SQLite expressions giving the first day of the period containing `day`.
+SUMMARY_PERIODS = {
+    'day': lambda day: func.date(day),
+    'week': lambda day: func.date(day, 'weekday 0', '-6 days'),
+    'month': lambda day: func.strftime('%Y-%m-01', day),
+}
+
+@rpccall
+def getSummary(**kwargs):
+    """Return the tracked seconds per day, week or month (granularity) and,
+    unless group_by is 'none', per activity, as [period, name, seconds]
+    rows; periods are named by their first day, as YYYY-MM-DD."""
+    uid = kwargs.get('uid')
+    granularity = kwargs.get('granularity', 'day')
+    group_by = kwargs.get('group_by', 'activity')
+    if granularity not in SUMMARY_PERIODS or group_by not in ('activity', 'none'):
+        return {'msg': 'Invalid granularity or group_by', 'error': True}
+    error = _invalid_dates(kwargs)
+    if error:
+        return error
+    t = dailytotal_table.c
+    act = activity_table.c
+    period = SUMMARY_PERIODS[granularity](t.day).label('period')
+    columns = [period]
+    if group_by == 'activity':
+        columns.append(act.name)
+    filters = [t.user_id==_user_key(uid)]
+    if kwargs.get('from'):
+        filters.append(t.day >= _parse_date(kwargs['from']).date())
+    if kwargs.get('to'):
+        filters.append(t.day <= _parse_date(kwargs['to']).date())
+    q = select(columns + [func.sum(t.seconds).label('seconds')], and_(*filters),
+               from_obj=[dailytotal_table.join(activity_table, t.activity_id==act.id)]
+               ).group_by(*columns).order_by(*columns)
+    totals = [list(row[:-1]) + [int(round(row.seconds))] for row in session.execute(q)]
+    return {'granularity': granularity, 'group_by': group_by, 'totals': totals}
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+}
+EXPORT_COLUMNS = ['id', 'activity', 'description', 'date_start', 'date_stop', 'seconds']
+EXPORT_CHUNK = 1000
+
+def _export_csv(rows):
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        # Empty fields for NULLs, where the JSON lines have null.
+        writer.writerow(['' if value is None else unicode(value).encode('utf-8')
+                         for value in row])
+    return buf.getvalue()
+
+def _export_jsonl(rows):
+    return ''.join([json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n' for row in rows])
+
+def exportLogs(**kwargs):
+    """Generate the completed logs of a user as chunks of CSV or JSON lines
+    (format), streamed from the database cursor so that memory use does not
+    depend on the size of the history."""
+    setup()
+    uid = kwargs.get('uid')
+    format = kwargs.get('format', 'csv')
+    encode = {'csv': _export_csv, 'jsonl': _export_jsonl}[format]
+    if format == 'csv':
+        yield _export_csv([EXPORT_COLUMNS])
+    log = activitylogs_table.c
+    act = activity_table.c
+    q = session.query(log.id, act.name, log.description,
+                      func.strftime('%Y-%m-%dT%H:%M:%S', log.date_start),
+                      func.strftime('%Y-%m-%dT%H:%M:%S', log.date_stop),
+                      _duration_seconds(log)) \
+        .select_from(activitylogs_table.join(activity_table, log.activity_id==act.id)) \
+        .filter(and_(act.user_id==uid, log.is_completed==True)) \
+        .order_by(log.date_start).yield_per(EXPORT_CHUNK)
+    chunk = []
+    for row in q:
+        chunk.append(tuple(row))
+        if len(chunk) == EXPORT_CHUNK:
+            yield encode(chunk)
+            chunk = []
+    if chunk:
+        yield encode(chunk)
+
+@rpccall
+def waitForChange(**kwargs):
+    """Return the user's data version and whether it moved past
+    since_version. This does not wait: the long-poll server in ttpoll.py
+    holds the request until the version changes or `timeout` expires."""
+    uid = kwargs.get('uid')
+    version = data_version(uid)
+    return {'version': version,
+            'changed': version > int(kwargs.get('since_version') or 0)}
+
 @rpccall
 def getMethods(**kwargs):
     return {'methods': METHODS}
 
+def batch(calls):
+    """Run a list of {method, params, id} calls in order, in a single
+    transaction, and return the list of their results. If a call raises
+    the whole batch is rolled back and every call reports an error."""
+    setup()
+    _enter()
+    results = []
+    _request.batch_depth = getattr(_request, 'batch_depth', 0) + 1
+    try:
+        for call in calls:
+            method = call.get('method')
+            params = dict([(str(k), v) for k, v in (call.get('params') or {}).items()])
+            params['id'] = call.get('id', 0)
+            if method not in METHODS:
+                results.append({'id': params['id'], 'error': True,
+                                'result': {'msg': 'Unknown method %s' % method}})
+                continue
+            results.append(globals()[method](**params))
+    except Exception, e:
+        _request.batch_depth -= 1
+        session.rollback()
+        _leave()
+        msg = 'Batch aborted: %s' % e
+        return [{'id': call.get('id', 0), 'result': {'msg': msg}, 'error': True}
+                for call in calls]
+    _request.batch_depth -= 1
+    try:
+        commit()
+    finally:
+        _leave()
+    return results
+
 if __name__ == '__main__':
     import time
     print startActivity(name="test")
@@ -0,0 +1,46 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Measure the cold import time of the functions module in a fresh
+# interpreter and fail when it exceeds the budget:
+#
+#     python importcheck.py [--budget SECONDS] [--runs N]
+
+import sys, os
+import subprocess
+from optparse import OptionParser
+
+curdir = os.path.abspath(os.path.dirname(__file__))
+
+# Seconds allowed for "import functions" in a new process.
+BUDGET = 0.5
+
+MEASURE = """
+import sys, time
+sys.path.insert(0, %r)
+start = time.time()
+import functions
+sys.stdout.write('%%f' %% (time.time() - start))
+""" % curdir
+
+def import_time():
+    child = subprocess.Popen([sys.executable, '-c', MEASURE], cwd=curdir,
+                             stdout=subprocess.PIPE)
+    output = child.communicate()[0]
+    if child.returncode:
+        raise RuntimeError("import functions failed")
+    return float(output)
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-b", "--budget", type="float", default=BUDGET,
+                      help="maximum import time in seconds (default: %default)")
+    parser.add_option("-n", "--runs", type="int", default=3,
+                      help="number of imports, the best one counts (default: %default)")
+    options, args = parser.parse_args()
+
+    best = min([import_time() for i in range(options.runs)])
+    print "import functions: %.3fs (budget %.3fs)" % (best, options.budget)
+    if best > options.budget:
+        print "FAILED: import time over budget"
+        sys.exit(1)
@@ -0,0 +1,28 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Maintenance commands for the timetracker database:
+#
+#     python manage.py rebuild-totals    recompute the daily totals table
+
+import sys, os
+
+curdir = os.path.join(os.path.dirname(__file__))
+if curdir not in sys.path:
+    sys.path.insert(0, curdir)
+
+import functions as server
+
+def rebuild_totals():
+    server.rebuildDailyTotals()
+    print "Daily totals rebuilt."
+
+COMMANDS = {
+    'rebuild-totals': rebuild_totals,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or sys.argv[1] not in COMMANDS:
+        print "usage: %s %s" % (sys.argv[0], '|'.join(sorted(COMMANDS)))
+        sys.exit(2)
+    COMMANDS[sys.argv[1]]()
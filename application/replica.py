@@ -0,0 +1,232 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Local SQLite replica of an rpcClient, for working offline. It keeps the
+# last result of each read call (by method and parameters) and a journal
+# of the mutating calls not yet sent to the server. A queued call is
+# applied at once to the stored reads, so that they show it before the
+# server has it; rpcClient replays the journal in the background.
+
+import sqlite3
+import threading
+import uuid
+from datetime import datetime, timedelta
+import simplejson as json
+
+# Reads answered from the replica, and calls queued in the journal.
+READS = ['getStatus', 'getActivities', 'getLogs', 'getLogsByDate']
+JOURNALED = ['startActivity', 'stopActivity']
+# Parameters that do not change the result of a call.
+IGNORED_PARAMS = ['method', 'output', 'id']
+# Parameters naming the user of a call: a queued call only patches the
+# reads of its own user.
+USER_PARAMS = ['token', 'uid']
+
+DATETIME_FORMAT = "%d/%m/%Y %H:%M:%S"
+
+# Replays of a journaled call that the server may fail, e.g. with a 5xx,
+# before the call is rejected.
+MAX_ATTEMPTS = 5
+
+SCHEMA = [
+"""CREATE TABLE IF NOT EXISTS journal (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL,
+    method TEXT NOT NULL,
+    params TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT)""",
+"""CREATE TABLE IF NOT EXISTS rejected (
+    seq INTEGER PRIMARY KEY,
+    method TEXT NOT NULL,
+    params TEXT NOT NULL,
+    error TEXT)""",
+"""CREATE TABLE IF NOT EXISTS reads (
+    method TEXT NOT NULL,
+    params TEXT NOT NULL,
+    result TEXT NOT NULL,
+    PRIMARY KEY (method, params))""",
+]
+
+def _native(params):
+    """Parameters read back from JSON, as urlencode and **kwargs take them."""
+    return dict([(str(k), isinstance(v, unicode) and v.encode('utf-8') or v)
+                 for k, v in params.items()])
+
+def _response(result):
+    # The server nests the whole getStatus response in its own results.
+    return {'id': 0, 'result': result, 'error': False}
+
+def params_key(params):
+    """Normalized JSON of the parameters of a call."""
+    return json.dumps(dict([(k, v) for k, v in params.items()
+                            if k not in IGNORED_PARAMS]), sort_keys=True)
+
+class Replica(object):
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+        # Bumped by every queued call; a refresh read before a bump must
+        # not overwrite the reads that the call patched.
+        self.generation = 0
+
+    def get(self, method, params):
+        """Return the stored result of a read, or None."""
+        with self.lock:
+            row = self.db.execute("SELECT result FROM reads WHERE method = ? AND params = ?",
+                                  (method, params_key(params))).fetchone()
+        if row is None:
+            return None
+        result = json.loads(row[0])
+        if method == 'getStatus' and result.get('start'):
+            result['current'] = datetime.now().strftime(DATETIME_FORMAT)
+        return result
+
+    def put(self, method, params, result, generation):
+        """Store the result of a read made by the server at `generation`,
+        unless the server may not have all the queued calls yet."""
+        with self.lock:
+            if generation != self.generation or \
+               self.db.execute("SELECT 1 FROM journal LIMIT 1").fetchone():
+                return
+            self.db.execute("INSERT OR REPLACE INTO reads (method, params, result) "
+                            "VALUES (?, ?, ?)",
+                            (method, params_key(params), json.dumps(result)))
+            self.db.commit()
+
+    def drop(self, method, params):
+        with self.lock:
+            self.db.execute("DELETE FROM reads WHERE method = ? AND params = ?",
+                            (method, params_key(params)))
+            self.db.commit()
+
+    def stored_reads(self):
+        with self.lock:
+            rows = self.db.execute("SELECT method, params FROM reads").fetchall()
+        return [(method, _native(json.loads(params))) for method, params in rows]
+
+    def queue(self, method, params):
+        """Journal a mutating call, stamped with the current time and an
+        idempotency key, and apply it to the stored reads. Return the
+        result the server would give."""
+        params = dict(params)
+        params.setdefault('at', datetime.now().strftime(DATETIME_FORMAT))
+        with self.lock:
+            self.generation += 1
+            try:
+                self.db.execute("INSERT INTO journal (key, method, params) VALUES (?, ?, ?)",
+                                (uuid.uuid4().hex, method, json.dumps(params)))
+                result = getattr(self, '_apply_' + method)(params)
+                self.db.commit()
+            except:
+                self.db.rollback()
+                raise
+        return result
+
+    def pending(self):
+        """Return the journaled calls as (seq, key, method, params), oldest
+        first."""
+        with self.lock:
+            rows = self.db.execute("SELECT seq, key, method, params FROM journal "
+                                   "ORDER BY seq").fetchall()
+        return [(seq, str(key), method, _native(json.loads(params)))
+                for seq, key, method, params in rows]
+
+    def done(self, seq):
+        with self.lock:
+            self.db.execute("DELETE FROM journal WHERE seq = ?", (seq,))
+            self.db.commit()
+
+    def failed(self, seq, error):
+        """Record a replay failed by the server, and return the number of
+        them so far."""
+        with self.lock:
+            self.db.execute("UPDATE journal SET attempts = attempts + 1, error = ? "
+                            "WHERE seq = ?", (str(error), seq))
+            self.db.commit()
+            row = self.db.execute("SELECT attempts FROM journal WHERE seq = ?",
+                                  (seq,)).fetchone()
+        return row and row[0] or 0
+
+    def reject(self, seq, error):
+        """Move a call that the server will not take from the journal to
+        the rejected calls, kept until dismissed."""
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO rejected (seq, method, params, error) "
+                            "SELECT seq, method, params, ? FROM journal WHERE seq = ?",
+                            (error, seq))
+            self.db.execute("DELETE FROM journal WHERE seq = ?", (seq,))
+            self.db.commit()
+
+    def rejected(self):
+        """Return the rejected calls as (seq, method, params, error), oldest
+        first."""
+        with self.lock:
+            rows = self.db.execute("SELECT seq, method, params, error FROM rejected "
+                                   "ORDER BY seq").fetchall()
+        return [(seq, method, _native(json.loads(params)), error)
+                for seq, method, params, error in rows]
+
+    def dismiss(self, seq):
+        with self.lock:
+            self.db.execute("DELETE FROM rejected WHERE seq = ?", (seq,))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    # The _apply_ methods patch the stored reads, in the transaction of
+    # queue(), mirroring what the server does for the call.
+
+    def _reads(self, method, params):
+        """The stored reads of `method` made by the user of a call."""
+        user = [params.get(name) for name in USER_PARAMS]
+        return [(key, json.loads(result)) for key, result in self.db.execute(
+                    "SELECT params, result FROM reads WHERE method = ?", (method,))
+                if [json.loads(key).get(name) for name in USER_PARAMS] == user]
+
+    def _update(self, method, params, result):
+        self.db.execute("UPDATE reads SET result = ? WHERE method = ? AND params = ?",
+                        (json.dumps(result), method, params))
+
+    def _apply_startActivity(self, params):
+        name = params['name']
+        status = {'name': name, 'start': params['at'], 'current': params['at']}
+        for key, result in self._reads('getStatus', params):
+            self._update('getStatus', key, status)
+        for key, result in self._reads('getActivities', params):
+            if name not in result:
+                self._update('getActivities', key, result + [name])
+        return {'msg': 'Activity %s started!' % name, 'status': _response(status),
+                'queued': True}
+
+    def _apply_stopActivity(self, params):
+        idle = {'name': 'none', 'start': ''}
+        statuses = self._reads('getStatus', params)
+        running = [result for key, result in statuses if result.get('start')]
+        for key, result in statuses:
+            self._update('getStatus', key, idle)
+        if not running:
+            # Without a known start the log can only be shown once synced.
+            return {'msg': 'Activity stopped!', 'status': _response(idle), 'queued': True}
+        name, descr = running[0]['name'], params.get('descr', '')
+        start = datetime.strptime(running[0]['start'], DATETIME_FORMAT)
+        stop = datetime.strptime(params['at'], DATETIME_FORMAT)
+        day = start.strftime("%d/%m/%Y")
+        # The id is only known once the server has the log.
+        entry = [None, descr, str(timedelta(seconds=int((stop - start).total_seconds()))),
+                 start.strftime("%H:%M"), stop.strftime("%H:%M")]
+        for method, outer, inner in (('getLogs', name, day), ('getLogsByDate', day, name)):
+            for key, result in self._reads(method, params):
+                filters = json.loads(key)
+                if filters.get('from') or filters.get('to') or filters.get('format'):
+                    continue
+                result.setdefault(outer, {}).setdefault(inner, []).append(entry)
+                self._update(method, key, result)
+        return {'msg': 'Activity %s (%s) stopped!' % (name, descr),
+                'status': _response(idle), 'queued': True}
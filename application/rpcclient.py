@@ -1,32 +1,783 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import sys
 import urllib
+import urlparse
+import httplib
+import socket
+import errno
+import threading
+import Queue
+import time
+import zlib
+import bisect
+import logging
 import simplejson as json
 import collections
+from collections import OrderedDict
 Result = collections.namedtuple('Result', 'id,result,error')
 
+CHUNK_SIZE = 16 * 1024
+# Seconds to wait for the server to accept a connection, and then for each
+# read of its response.
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+# Read methods are sent again up to RETRIES times after a network error or
+# a 5xx, waiting RETRY_BACKOFF seconds before the first retry and twice as
+# long before each of the next.
+RETRIES = 2
+RETRY_BACKOFF = 0.5
+READ_METHODS = set(['getStatus', 'getActivities', 'getItem', 'getLogs',
+                    'getLogsByDate', 'getLogsSince', 'getSummary',
+                    'getMethods', 'waitForChange'])
+# Idle connections are kept this many seconds, less than the keep-alive
+# timeout of ttwsgi, so that the server is never the first to drop them.
+IDLE_TIMEOUT = 10
+POOL_SIZE = 4
+# Threads running the calls made with call_async.
+WORKERS = 2
+# Upper bounds in seconds of the buckets of the latency histograms; the
+# last bucket counts the latencies above the largest bound.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30)
+# connect: opening a new connection; server: sending the request until the
+# response headers arrive; decode: reading, inflating and parsing the body.
+PHASES = ('connect', 'server', 'decode', 'total')
+STATS_INTERVAL = 300
+# Seconds a cached result stays valid, by read method, for clients with a
+# response cache; methods not listed are never cached.
+CACHE_TTLS = {
+    'getStatus': 5,
+    'getActivities': 300,
+    'getItem': 60,
+    'getLogs': 60,
+    'getLogsByDate': 60,
+    'getLogsSince': 60,
+    'getSummary': 60,
+    'getMethods': 3600,
+}
+CACHE_SIZE = 200
+ALL_READS = sorted(CACHE_TTLS)
+LOG_READS = ['getItem', 'getLogs', 'getLogsByDate', 'getLogsSince', 'getSummary']
+# Cached reads made stale by each mutating method.
+INVALIDATES = {
+    'startActivity': ['getStatus', 'getActivities'],
+    'stopActivity': ['getStatus'] + LOG_READS,
+    'editItem': ['getStatus', 'getActivities'] + LOG_READS,
+    'editItems': ['getStatus', 'getActivities'] + LOG_READS,
+    'deleteItem': ['getStatus'] + LOG_READS,
+    'deleteItems': ['getStatus'] + LOG_READS,
+    'importLogs': ['getActivities'] + LOG_READS,
+    # A new user may have been read as an unknown one before.
+    'addUser': ALL_READS,
+}
+
+# Reads whose last ETag and result a client keeps to revalidate them; each
+# getLogsSince call has a new cursor, and so a URL never asked again.
+ETAG_SIZE = 100
+ETAG_SKIPPED = ['getLogsSince']
+
+# Seconds between two replays of the journal of a replica, and refreshes
+# of its reads, when no queued call triggers one earlier.
+SYNC_INTERVAL = 30
+
+log = logging.getLogger('rpcclient')
+log.addHandler(logging.NullHandler())
+
+class GzipReader(object):
+    """File-like reader inflating a gzip encoded response as it is read,
+    so that the compressed body is never held in memory as a whole."""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        # wbits=31 expects the gzip header and trailer.
+        self.decompressor = zlib.decompressobj(31)
+
+    def read(self, size=-1):
+        chunks = []
+        length = 0
+        while size < 0 or length < size:
+            data = self.fileobj.read(CHUNK_SIZE)
+            if not data:
+                chunks.append(self.decompressor.flush())
+                break
+            chunk = self.decompressor.decompress(data)
+            chunks.append(chunk)
+            length += len(chunk)
+        return ''.join(chunks)
+
+class CountingReader(object):
+    """Response wrapper counting the body bytes read from the wire."""
+    def __init__(self, response):
+        self.response = response
+        self.bytes = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            data = self.response.read()
+        else:
+            data = self.response.read(size)
+        self.bytes += len(data)
+        return data
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+def read_response(response):
+    """Decode the JSON body of a response, inflating it if gzip encoded."""
+    if response.getheader('Content-Encoding') == 'gzip':
+        response = GzipReader(response)
+    return json.load(response)
+
+class HTTPStatusError(httplib.HTTPException):
+    """The server answered with an unexpected HTTP status."""
+    def __init__(self, status, reason):
+        httplib.HTTPException.__init__(self, '%d %s' % (status, reason))
+        self.status = status
+
+class ConnectionPool(object):
+    """Persistent HTTP/1.1 connections, kept idle between calls and reused
+    for the next request to the same host."""
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 size=POOL_SIZE):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.size = size
+        self.lock = threading.Lock()
+        # (scheme, netloc) -> [(connection, idle since)]
+        self.idle = {}
+
+    def _get(self, key):
+        now = time.time()
+        with self.lock:
+            idle = self.idle.get(key, [])
+            while idle:
+                conn, since = idle.pop()
+                if now - since < IDLE_TIMEOUT:
+                    return conn, True
+                conn.close()
+        scheme, netloc = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.connect_timeout), False
+        return httplib.HTTPConnection(netloc, timeout=self.connect_timeout), False
+
+    def request(self, method, url, body=None, headers={}, read_timeout=None,
+                measures=None):
+        """Send a request and return the response, whose body is still to
+        be read; hand it back to release() once read. The connect and
+        server times and the request size are added to measures."""
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        if query:
+            path += '?' + query
+        key = (scheme, netloc)
+        conn, reused = self._get(key)
+        if measures is None:
+            measures = new_measures()
+        started = time.time()
+        try:
+            if conn.sock is None:
+                conn.connect()
+                conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                measures['connections'] += 1
+            connected = time.time()
+            measures['connect'] += connected - started
+            conn.sock.settimeout(read_timeout or self.read_timeout)
+            # Request line, the headers set here and the body.
+            measures['request_bytes'] += len(method) + len(path) + 11 + len(body or '') + \
+                sum([len(k) + len(v) + 4 for k, v in headers.items()])
+            conn.request(method, path or '/', body, headers)
+            response = conn.getresponse()
+            measures['server'] += time.time() - connected
+        except socket.timeout:
+            conn.close()
+            raise
+        except (socket.error, httplib.BadStatusLine), e:
+            conn.close()
+            if not reused or getattr(e, 'errno', None) not in \
+               (None, errno.ECONNRESET, errno.EPIPE):
+                raise
+            # The server dropped the idle connection before reading the
+            # request: send it again on a new one.
+            return self.request(method, url, body, headers, read_timeout, measures)
+        except:
+            conn.close()
+            raise
+        response.pool_key = key
+        response.connection = conn
+        return response
+
+    def release(self, response):
+        conn = response.connection
+        if response.will_close or not response.isclosed():
+            conn.close()
+            return
+        with self.lock:
+            idle = self.idle.setdefault(response.pool_key, [])
+            if len(idle) < self.size:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn, since in idle:
+                    conn.close()
+            self.idle = {}
+
+class CallPending(Exception):
+    """The call of a Future is still running."""
+
+class ResponseCache(object):
+    """Thread safe LRU map from a read call, its method and normalized
+    parameters, to its result, whose entries expire after the TTL of the
+    method in `ttls`."""
+    def __init__(self, size=CACHE_SIZE, ttls=CACHE_TTLS):
+        self.size = size
+        self.ttls = ttls
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        # Bumped by every invalidation; a read sent before a bump may
+        # have missed the change and is not added.
+        self.epoch = 0
+
+    def cacheable(self, method):
+        return method in self.ttls
+
+    def _key(self, method, params):
+        # uid=1 and uid='1' are the same call.
+        return (method, tuple(sorted([(k, isinstance(v, basestring) and v or str(v))
+                                      for k, v in params.items()
+                                      if k not in ('id', 'method', 'output')])))
+
+    def get(self, method, params):
+        """Return the cached Result of the call, or None."""
+        key = self._key(method, params)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] < time.time():
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+        # A copy, which callers are free to change.
+        return entry[0]._replace(result=json.loads(entry[2]))
+
+    def add(self, method, params, result, epoch):
+        """Cache the result of a read sent at `epoch`, unless an
+        invalidation happened since."""
+        key = self._key(method, params)
+        with self.lock:
+            if epoch != self.epoch:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (result, time.time() + self.ttls[method],
+                                 json.dumps(result.result))
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, method):
+        """Drop the cached reads that a call of `method` makes stale."""
+        methods = INVALIDATES.get(method)
+        if not methods:
+            return
+        with self.lock:
+            self.epoch += 1
+            for key in self.entries.keys():
+                if key[0] in methods:
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.entries.clear()
+
+class ETagCache(object):
+    """Thread safe LRU map from the URL of a read to the ETag and the
+    JSON body of its last response."""
+    def __init__(self, size=ETAG_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        """Return the (etag, body) of the last response, or None."""
+        with self.lock:
+            entry = self.entries.pop(url, None)
+            if entry is not None:
+                self.entries[url] = entry
+        return entry
+
+    def add(self, url, etag, body):
+        # Kept as JSON, so that each 304 gets a copy of its own.
+        entry = (etag, json.dumps(body))
+        with self.lock:
+            self.entries.pop(url, None)
+            self.entries[url] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+class Future(object):
+    """Pending result of a call made with rpcClient.call_async."""
+    def __init__(self, dispatch=None):
+        self.dispatch = dispatch
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.callbacks = []
+        self.value = None
+        self.exc_info = None
+
+    def done(self):
+        return self.event.isSet()
+
+    def _wait(self, timeout):
+        self.event.wait(timeout)
+        if not self.event.isSet():
+            raise CallPending('%s seconds elapsed' % timeout)
+
+    def result(self, timeout=None):
+        """Return the Result of the call, waiting for it at most timeout
+        seconds, or raise the exception the call raised."""
+        self._wait(timeout)
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        if self.exc_info:
+            return self.exc_info[1]
+
+    def add_done_callback(self, fn):
+        """Call fn(future) once the call is over, through the dispatch
+        function of the client when it has one."""
+        with self.lock:
+            if not self.event.isSet():
+                self.callbacks.append(fn)
+                return
+        self._run(fn)
+
+    def _set(self, value=None, exc_info=None):
+        with self.lock:
+            self.value = value
+            self.exc_info = exc_info
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for fn in callbacks:
+            self._run(fn)
+
+    def _run(self, fn):
+        if self.dispatch:
+            self.dispatch(fn, self)
+        else:
+            fn(self)
+
+def new_measures():
+    measures = dict.fromkeys(PHASES, 0.0)
+    measures.update(dict.fromkeys(['connections', 'retries', 'request_bytes',
+                                   'response_bytes'], 0))
+    return measures
+
+class Histogram(object):
+    """Latencies counted by LATENCY_BUCKETS bucket."""
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the given percentile."""
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS + (self.max,), self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.max)
+        return 0.0
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'p50': self.percentile(50), 'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                # None bounds the latencies above the largest bucket.
+                'buckets': zip(LATENCY_BUCKETS + (None,), self.counts)}
+
+class Stats(object):
+    """Counters, payload sizes and latency histograms of the calls of a
+    client, by method."""
+    COUNTERS = ('calls', 'errors', 'failed', 'connections', 'retries',
+                'request_bytes', 'response_bytes')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = {}
+
+    def _method(self, method):
+        if method not in self.methods:
+            counters = dict.fromkeys(self.COUNTERS, 0)
+            counters['latency'] = dict([(phase, Histogram()) for phase in PHASES])
+            self.methods[method] = counters
+        return self.methods[method]
+
+    def record(self, method, measures, error=False):
+        """Account a call, errors being calls that raised."""
+        with self.lock:
+            counters = self._method(method)
+            counters['calls'] += 1
+            counters['errors'] += bool(error)
+            for name in ('connections', 'retries', 'request_bytes', 'response_bytes'):
+                counters[name] += measures[name]
+            for phase in PHASES:
+                counters['latency'][phase].add(measures[phase])
+
+    def failed(self, method):
+        """Account a call answered with an error result."""
+        with self.lock:
+            self._method(method)['failed'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            stats = {}
+            for method, counters in self.methods.items():
+                stats[method] = dict([(name, counters[name]) for name in self.COUNTERS])
+                stats[method]['latency'] = dict([(phase, histogram.snapshot())
+                    for phase, histogram in counters['latency'].items()])
+            return stats
+
+def format_stats(stats):
+    """Render the result of rpcClient.stats() as a table, latencies being
+    mean/p95 in milliseconds."""
+    lines = ['%-16s %6s %6s %6s %5s %10s %10s %13s %13s %13s %13s' % (
+        'method', 'calls', 'errors', 'failed', 'conns', 'req bytes', 'resp bytes',
+        'connect', 'server', 'decode', 'total')]
+    for method in sorted(stats):
+        counters = stats[method]
+        latencies = []
+        for phase in PHASES:
+            histogram = counters['latency'][phase]
+            mean = histogram['count'] and histogram['sum'] / histogram['count']
+            latencies.append('%6.1f/%6.1f' % (mean * 1000, histogram['p95'] * 1000))
+        lines.append('%-16s %6d %6d %6d %5d %10d %10d %s' % ((method,) +
+            tuple([counters[name] for name in Stats.COUNTERS if name != 'retries']) +
+            (' '.join(latencies),)))
+    return '\n'.join(lines)
+
+class StatsReport(object):
+    """Formats the stats only when logged."""
+    def __init__(self, client):
+        self.client = client
+
+    def __str__(self):
+        return format_stats(self.client.stats())
+
 SEARCH_BASE = 'http://www.terranovanet.it/cgi-bin/ttweb/ttweb.py'
 
 class rpcClient(object):
-    def __init__(self, proxy=None):
+    def __init__(self, proxy=None, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, retries=RETRIES, dispatch=None,
+                 workers=WORKERS, replica=None, cache=False):
         self.id = 0        
         self.proxy = proxy or SEARCH_BASE
+        self.pool = ConnectionPool(connect_timeout, read_timeout)
+        self.retries = retries
+        # Runs the callbacks of call_async futures, e.g. wx.CallAfter to
+        # have them on the GUI thread; by default they run on the worker.
+        self.dispatch = dispatch
+        self.workers = workers
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.threads_lock = threading.Lock()
+        self.metrics = Stats()
+        # Local replica, or the path of its database, answering the reads
+        # and queuing the calls it knows, see replica.py.
+        if isinstance(replica, basestring):
+            import replica as replicas
+            replica = replicas.Replica(replica)
+        self.replica = replica
+        # Called, through dispatch, with the method, parameters and error
+        # of each queued call that the server rejects; see rejected_calls.
+        self.on_rejected = None
+        self.sync_event = threading.Event()
+        self.sync_thread = None
+        if replica:
+            self._start_sync()
+        # Opt-in cache of read results: True for the default TTLs and
+        # size, or a ResponseCache.
+        if cache is True:
+            cache = ResponseCache()
+        self.cache = cache or None
+        # Session token from the last authUser/changePassword, sent with
+        # every call that does not name its user.
+        self.token = None
+        # Last ETag and result received for each method and parameters,
+        # revalidated with If-None-Match.
+        self.etags = ETagCache()
+
+    def _request(self, method, url, body=None, headers={}, read_timeout=None,
+                 measures=None):
+        """Return the status and the decoded body of a response, following
+        a redirect to the long-poll server."""
+        response = self.pool.request(method, url, body, headers, read_timeout, measures)
+        if response.status in (301, 302, 303, 307):
+            try:
+                response.read()
+                location = response.getheader('Location')
+            finally:
+                self.pool.release(response)
+            response = self.pool.request('GET', location, None, headers,
+                                         read_timeout, measures)
+        try:
+            if response.status >= 300:
+                response.read()
+                if response.status == 304:
+                    return response.status, None, None
+                raise HTTPStatusError(response.status, response.reason)
+            started = time.time()
+            reader = CountingReader(response)
+            result = read_response(reader)
+            measures['decode'] += time.time() - started
+            measures['response_bytes'] += reader.bytes
+            return response.status, result, response.getheader('ETag')
+        finally:
+            self.pool.release(response)
+
+    def _call(self, name, idempotent, send):
+        """Call send(measures), again after a failure as long as the request
+        is idempotent and retries are left, and account it in the stats."""
+        measures = new_measures()
+        started = time.time()
+        delay = RETRY_BACKOFF
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    value = send(measures)
+                    break
+                except (socket.error, httplib.HTTPException), e:
+                    if not idempotent or attempt == self.retries or \
+                       (isinstance(e, HTTPStatusError) and e.status < 500):
+                        raise
+                    log.warning("RPC: Retrying %s after error: %s", name, e)
+                    measures['retries'] += 1
+                    time.sleep(delay)
+                    delay *= 2
+        except:
+            measures['total'] = time.time() - started
+            self.metrics.record(name, measures, error=True)
+            raise
+        measures['total'] = time.time() - started
+        self.metrics.record(name, measures)
+        return value
 
     def _rpc(self, method, **kwargs):
+        if self.cache is None:
+            return self._uncached(method, **kwargs)
+        if not self.cache.cacheable(method):
+            try:
+                return self._uncached(method, **kwargs)
+            finally:
+                self.cache.invalidate(method)
+        # The token picks the user of calls that do not name one.
+        params = dict(kwargs, token=self.token)
+        result = self.cache.get(method, params)
+        if result is None:
+            epoch = self.cache.epoch
+            result = self._uncached(method, **kwargs)
+            if not result.error:
+                self.cache.add(method, params, result, epoch)
+        return result
+
+    def _uncached(self, method, **kwargs):
+        if self.replica is None:
+            return self._remote(method, **kwargs)
+        # Only clients with a replica need replica.py.
+        import replica as replicas
+        if self.token and 'uid' not in kwargs:
+            # Part of the replica's keys: the reads of a user are never
+            # served to the next one to log in.
+            kwargs = dict(kwargs, token=self.token)
+        if method in replicas.JOURNALED:
+            result = self.replica.queue(method, kwargs)
+            log.debug("RPC: Queued %s: %s", method, kwargs)
+            self.sync_event.set()
+            return Result(id=0, result=result, error=False)
+        if method in replicas.READS:
+            result = self.replica.get(method, kwargs)
+            if result is not None:
+                return Result(id=0, result=result, error=False)
+            generation = self.replica.generation
+            result = self._remote(method, **kwargs)
+            if not result.error:
+                self.replica.put(method, kwargs, result.result, generation)
+            return result
+        return self._remote(method, **kwargs)
+
+    def _remote(self, method, **kwargs):
+        if self.token and 'uid' not in kwargs:
+            kwargs.setdefault('token', self.token)
         kwargs.update({'method': method, 'output': 'json'})
-        url = SEARCH_BASE + '?' + urllib.urlencode(kwargs)
-        print "RPC: Method: %s Params: %s" % (method, kwargs)
-        result = json.load(urllib.urlopen(url))
+        url = self.proxy + '?' + urllib.urlencode(sorted(kwargs.items()))
+        log.debug("RPC: Method: %s Params: %s", method, kwargs)
+        headers = {'Accept-Encoding': 'gzip'}
+        cached = self.etags.get(url)
+        if cached:
+            headers['If-None-Match'] = cached[0]
+        read_timeout = None
+        if method == 'waitForChange':
+            # The server holds the call for up to `timeout` seconds.
+            read_timeout = self.pool.read_timeout + float(kwargs.get('timeout', 30))
+        status, result, etag = self._call(method, method in READ_METHODS,
+            lambda measures: self._request('GET', url, None, headers, read_timeout, measures))
+        if status == 304 and cached:
+            result = json.loads(cached[1])
+        elif status == 304:
+            raise HTTPStatusError(304, 'Not Modified')
+        elif etag and method not in ETAG_SKIPPED:
+            self.etags.add(url, etag, result)
         result = dict([(str(k), v) for k, v in result.items()])
-        print "RPC: Result:", result
+        log.debug("RPC: Result: %s", result)
         
         if result['error']:
-            print "ERROR"
+            self.metrics.failed(method)
+            log.warning("RPC: %s failed: %s", method, result['result'])
+        elif type(result['result']) == dict and 'token' in result['result']:
+            self.token = result['result']['token']
         # namedtuple doesn't work with unicode keys.
         return Result(id=result['id'], result=result['result'],
                       error=result['error'], )
 
+    def sync(self):
+        """Replay the journal of the replica to the server, then refresh
+        its reads. Return False if the server could not be reached, or
+        failed a call that is kept queued for another try."""
+        import replica as replicas
+        for seq, key, method, params in self.replica.pending():
+            try:
+                result = self._remote(method, idempotency_key=key, **params)
+            except socket.error, e:
+                log.info("RPC: Server unreachable, %s kept queued: %s", method, e)
+                return False
+            except httplib.HTTPException, e:
+                # A 4xx would be the same on every replay, a 5xx may be.
+                if self.replica.failed(seq, e) < replicas.MAX_ATTEMPTS and \
+                   not (isinstance(e, HTTPStatusError) and e.status < 500):
+                    log.info("RPC: Server failed, %s kept queued: %s", method, e)
+                    return False
+                self._reject(seq, method, params, str(e))
+                continue
+            if result.error:
+                # Replaying would get the same answer, e.g. a stop with
+                # nothing running.
+                self._reject(seq, method, params, isinstance(result.result, dict) and
+                             result.result.get('msg') or str(result.result))
+                continue
+            self.replica.done(seq)
+        for method, params in self.replica.stored_reads():
+            generation = self.replica.generation
+            try:
+                result = self._remote(method, **params)
+            except (socket.error, httplib.HTTPException), e:
+                log.info("RPC: Server unreachable, %s not refreshed: %s", method, e)
+                return False
+            if not result.error:
+                self.replica.put(method, params, result.result, generation)
+            elif params.get('token') not in (None, self.token):
+                # Read with a token since replaced, which may have expired.
+                self.replica.drop(method, params)
+        return True
+
+    def _reject(self, seq, method, params, error):
+        log.warning("RPC: Queued %s rejected: %s", method, error)
+        self.replica.reject(seq, error)
+        if self.on_rejected and self.dispatch:
+            self.dispatch(self.on_rejected, method, params, error)
+        elif self.on_rejected:
+            self.on_rejected(method, params, error)
+
+    def rejected_calls(self):
+        """Return the queued calls that the server rejected, as (seq,
+        method, params, error), until they are dismissed."""
+        return self.replica.rejected()
+
+    def dismiss_rejected(self, seq):
+        self.replica.dismiss(seq)
+
+    def _start_sync(self):
+        def run():
+            while True:
+                self.sync_event.wait(SYNC_INTERVAL)
+                self.sync_event.clear()
+                try:
+                    self.sync()
+                except Exception:
+                    log.exception("RPC: Sync failed")
+        self.sync_thread = threading.Thread(target=run)
+        self.sync_thread.setDaemon(True)
+        self.sync_thread.start()
+
+    def stats(self):
+        """Return the counters, byte sizes and latency histograms of the
+        calls made so far, by method; batches are accounted as 'batch'."""
+        return self.metrics.snapshot()
+
+    def dump_stats(self, interval=STATS_INTERVAL):
+        """Log the stats at INFO level every interval seconds."""
+        def dump():
+            while True:
+                time.sleep(interval)
+                log.info("RPC: Stats:\n%s", StatsReport(self))
+        thread = threading.Thread(target=dump)
+        thread.setDaemon(True)
+        thread.start()
+
+    def close(self):
+        """Close the idle connections."""
+        self.pool.close()
+
+    def call_async(self, method, **kwargs):
+        """Queue the call for a worker thread and return its Future at
+        once:
+
+            client.call_async('getStatus').add_done_callback(show_status)
+        """
+        future = Future(self.dispatch)
+        with self.threads_lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._work)
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        self.queue.put((future, method, kwargs))
+        return future
+
+    def _work(self):
+        while True:
+            future, method, kwargs = self.queue.get()
+            try:
+                result = self._rpc(method, **kwargs)
+            except:
+                future._set(exc_info=sys.exc_info())
+            else:
+                future._set(result)
+
+    def batch(self):
+        """Collect calls and send them in a single request, run by the
+        server in one transaction:
+
+            with client.batch() as b:
+                b.stopActivity(uid=1, descr='done')
+                b.getLogsByDate(uid=1)
+            status, logs = b.results
+        """
+        return rpcBatch(self)
+
     def __getattr__(self, method):
         if not self.__dict__.has_key(method):
             def func(**kwargs):
@@ -34,3 +785,45 @@ class rpcClient(object):
             return func
         return self.__dict__[attrName]            
 
+
+class rpcBatch(object):
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self.calls:
+            self.results = self._send()
+
+    def _send(self):
+        log.debug("RPC: Batch: %s", self.calls)
+        body = json.dumps(self.calls)
+        headers = {'Content-Type': 'application/json', 'Accept-Encoding': 'gzip'}
+        idempotent = all([c['method'] in READ_METHODS for c in self.calls])
+        try:
+            status, results, etag = self.client._call('batch', idempotent,
+                lambda measures: self.client._request('POST', self.client.proxy, body,
+                                                      headers, None, measures))
+        finally:
+            if self.client.cache is not None:
+                for call in self.calls:
+                    self.client.cache.invalidate(call['method'])
+        log.debug("RPC: Batch result: %s", results)
+        return [Result(id=r['id'], result=r['result'], error=r['error'])
+                for r in results]
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        def func(**kwargs):
+            if self.client.token and 'uid' not in kwargs:
+                kwargs.setdefault('token', self.client.token)
+            self.client.id += 1
+            self.calls.append({'method': method, 'params': kwargs,
+                               'id': self.client.id})
+            return len(self.calls) - 1
+        return func
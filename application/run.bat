@@ -2,6 +2,7 @@ set Path=%Path%;C:\Users\g.terranova\Downloads\android-sdk-windows\platform-tool
 adb push script.py /sdcard/sl4a/scripts/test/
 
 adb push rpcclient.py /sdcard/sl4a/scripts/test
+adb push replica.py /sdcard/sl4a/scripts/test
 adb push html/template.html /sdcard/sl4a/scripts/test/html
 adb push application.zip /sdcard/sl4a/scripts/test
 rem adb push js/json2.js /sdcard/sl4a/scripts/test/js
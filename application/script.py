@@ -4,7 +4,6 @@ import time
 import urllib
 import simplejson as json
 from rpcclient import rpcClient
-client = rpcClient()
 
 PATH_BASE = '/sdcard/sl4a/scripts/test/'
 
@@ -56,6 +55,9 @@ if os.path.exists( PATH_BASE ) is False:
     exit()
 os.chdir(PATH_BASE)
 
+# Starts and stops are queued here while the server is out of reach.
+client = rpcClient(replica=os.path.join(PATH_BASE, 'replica.db'))
+
 class UIHandler(object):
   def __init__(self, waitfor=None, post=None):
     # Name of the event to wait for - default python
@@ -129,6 +131,13 @@ class Application(UIHandler):
   def run(self):
     droid = self.droid    
     while 1:
+      # Starts and stops made offline that the server refused.
+      rejected = client.rejected_calls()
+      for seq, method, params, error in rejected:
+        droid.makeToast('%s at %s refused: %s' % (method, params.get('at'), error))
+        client.dismiss_rejected(seq)
+      if rejected:
+        self.status = client.getStatus().result
       if self.activityRunning():
         message = "Working on %(name)s (started on %(start)s)." % self.status
       else:
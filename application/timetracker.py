@@ -9,17 +9,32 @@ import time
 
 LOCAL = False
 
+def user_data_dir():
+    """Per-user writable directory for local data: the program's own may be
+    read-only once installed, or a zip under py2exe."""
+    if os.name == 'nt':
+        path = os.path.join(os.environ.get('APPDATA') or os.path.expanduser('~'),
+                            'Timetracker')
+    else:
+        path = os.path.join(os.path.expanduser('~'), '.timetracker')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
 if LOCAL:
     import functions as client
 
 else:
     from rpcclient import rpcClient
-    client = rpcClient()
+    # Callbacks of asynchronous calls run on the GUI thread; starts and
+    # stops are queued in the replica while the server is out of reach.
+    client = rpcClient(dispatch=wx.CallAfter,
+                       replica=os.path.join(user_data_dir(), 'replica.db'))
         
 class main:
     def __init__(self):
         args = dict()
-        self.dynamic_choices = client.getActivities().result
+        self.dynamic_choices = []
         args["choices"] = self.dynamic_choices        
         if len(args["choices"]) ==0:
             args["choices"].append("No activities")
@@ -78,12 +93,74 @@ class main:
         panel.Layout()
 
         self.populate_by_date = True
+        self.tree_request = 0
         self.populateTree(self.populate_by_date)
 
         app.SetTopWindow(self.frame)
         self.frame.Bind(wx.EVT_TIMER, self.OnTimer)
 
-        status = client.getStatus().result
+        # Nothing can be started or stopped until the status is known.
+        self.but.Disable()
+        self._ctrl.Disable()
+        self.start_time = datetime.datetime.now()
+        self.title_format = "Timetracker - [idle] [%s]"
+        self.call('getActivities', self.setActivities)
+        self.refreshStatus()
+        if not LOCAL:
+            client.on_rejected = self.showRejected
+            self.showRejected()
+
+        self.OnTimer(None)
+        self.timer = wx.Timer(self.frame, -1)
+        # update clock digits every second (1000ms)
+        self.timer.Start(1000)        
+        
+        self.frame.Show()
+        self._ctrl.SetFocus()
+        app.MainLoop()
+
+    def call(self, method, callback=None, failed=None, **kwargs):
+        """Run the RPC on a worker thread and pass its result to callback
+        back on the GUI thread, unless the window is gone by then."""
+        def done(future):
+            if not self.frame:
+                return
+            try:
+                result = future.result()
+            except Exception, e:
+                wx.MessageBox("%s failed: %s" % (method, e), "Timetracker",
+                              wx.OK|wx.ICON_ERROR, self.frame)
+                if failed:
+                    failed()
+                return
+            if callback:
+                callback(result.result)
+        client.call_async(method, **kwargs).add_done_callback(done)
+
+    def showRejected(self, *rejected):
+        """Tell about the queued starts and stops that the server refused,
+        and show the status and logs it has instead."""
+        calls = client.rejected_calls()
+        if not calls or not self.frame:
+            return
+        # Dismissed first: more calls may be reported while the box is up.
+        for seq, method, params, error in calls:
+            client.dismiss_rejected(seq)
+        wx.MessageBox("These changes made offline were refused by the server:\n\n" +
+                      "\n".join(["%s at %s: %s" % (method, params.get('at'), error)
+                                 for seq, method, params, error in calls]),
+                      "Timetracker", wx.OK|wx.ICON_WARNING, self.frame)
+        self.refreshStatus()
+        self.populateTree(self.populate_by_date)
+
+    def refreshStatus(self):
+        self.call('getStatus', self.showStatus)
+
+    def setActivities(self, activities):
+        self.dynamic_choices[:] = activities or ["No activities"]
+        self.setDynamicChoices()
+
+    def showStatus(self, status):
         if status['name'] != "none":
             self.but.Disable()
             self.but2.Enable()
@@ -99,15 +176,7 @@ class main:
             ctrl.Enable()
             self.start_time = datetime.datetime.now()
             self.title_format = "Timetracker - [idle] [%s]"
-        
         self.OnTimer(None)
-        self.timer = wx.Timer(self.frame, -1)
-        # update clock digits every second (1000ms)
-        self.timer.Start(1000)        
-        
-        self.frame.Show()
-        self._ctrl.SetFocus()
-        app.MainLoop()
 
     def OnTimer(self, event):
         #get current time from computer
@@ -117,15 +186,23 @@ class main:
         self.frame.SetTitle(self.title_format % str(ts).split(".")[0])
 
     def populateTree(self, by_date=False):
+        self.tree_request += 1
+        request = self.tree_request
+        if not by_date:
+            method = 'getLogs'
+        else:
+            method = 'getLogsByDate'
+        self.call(method, lambda logs: self.fillTree(logs, request))
+
+    def fillTree(self, logs, request):
+        # Only the logs of the latest request are shown.
+        if request != self.tree_request:
+            return
         self.tree.DeleteAllItems()
         self.root = self.tree.AddRoot("Activities")
         self.tree.SetItemImage(self.root, self.fldridx,wx.TreeItemIcon_Normal)
         self.tree.SetItemImage(self.root, self.fldropenidx,wx.TreeItemIcon_Expanded)
 
-        if not by_date:
-            logs = client.getLogs().result
-        else:
-            logs = client.getLogsByDate().result
         for (k, v) in logs.items():
             act = self.tree.AppendItem(self.root, k)
             self.tree.SetItemImage(act, self.fldridx,wx.TreeItemIcon_Normal)
@@ -145,7 +222,7 @@ class main:
 #        self.frame.SetTitle("Timetracker - %s" % text)
         self.start_time = datetime.datetime.now()
         self.title_format = "Timetracker - %s [%%s]"  % text       
-        client.startActivity(name=text)
+        self.call('startActivity', failed=self.refreshStatus, name=text)
         if text not in self.dynamic_choices:
             self.dynamic_choices.append(text)
 
@@ -162,8 +239,8 @@ class main:
         self.start_time = datetime.datetime.now()
         self.title_format = "Timetracker - [idle] [%s]"
 #        self.frame.SetTitle("Timetracker - [idle]")
-        client.stopActivity(descr=descr)
-        self.populateTree(self.populate_by_date)
+        self.call('stopActivity', lambda result: self.populateTree(self.populate_by_date),
+                  failed=self.refreshStatus, descr=descr)
 
     def onBtShowLog(self, event):
         self.populate_by_date = not self.populate_by_date
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Long-poll server for waitForChange. Every request parked here is a socket
+# in a single asyncore loop, not a thread: the loop checks the data version
+# of all the waiting users with one query every POLL_INTERVAL seconds and
+# answers those whose version moved past since_version, or whose timeout
+# expired. ttwsgi.py starts it next to the WSGI server and redirects
+# waitForChange calls to it.
+#
+#     GET /?uid=1&since_version=42&timeout=30
+
+import sys, os
+import asyncore
+import asynchat
+import socket
+import time
+import traceback
+import cgi as cgimodule
+from optparse import OptionParser
+
+curdir = os.path.join(os.path.dirname(__file__))
+if curdir not in sys.path:
+    sys.path.insert(0, curdir)
+
+import simplejson as json
+import functions as server
+
+HOST = ''
+PORT = 8081
+# Seconds between two checks of the waiting users' versions.
+POLL_INTERVAL = 0.5
+DEFAULT_TIMEOUT = 30
+MAX_TIMEOUT = 300
+
+class PollChannel(asynchat.async_chat):
+    def __init__(self, sock, pollserver):
+        asynchat.async_chat.__init__(self, sock, map=pollserver.map)
+        self.pollserver = pollserver
+        self.data = []
+        self.set_terminator('\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        self.data.append(data)
+
+    def found_terminator(self):
+        self.set_terminator(None)
+        request_line = ''.join(self.data).split('\r\n', 1)[0]
+        try:
+            path = request_line.split()[1]
+        except IndexError:
+            self.respond({'id': 0, 'result': {'msg': 'Bad request'}, 'error': True})
+            return
+        kwargs = dict([(k, v[0]) for k, v in
+                       cgimodule.parse_qs(path.partition('?')[2]).items()])
+        self.pollserver.wait(self, kwargs)
+
+    def respond(self, result):
+        body = json.dumps(result)
+        self.push('HTTP/1.0 200 OK\r\n'
+                  'Content-Type: application/json\r\n'
+                  'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+        self.close_when_done()
+
+    def handle_close(self):
+        self.pollserver.waiters.pop(self, None)
+        self.close()
+
+class PollServer(asyncore.dispatcher):
+    def __init__(self, host=HOST, port=PORT):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        # channel -> (call id, uid, since_version, deadline)
+        self.waiters = {}
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(256)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            PollChannel(pair[0], self)
+
+    def wait(self, channel, kwargs):
+        id = kwargs.get('id', 0)
+        try:
+            uid = server.request_user(kwargs)
+            if 'token' in kwargs and uid is None:
+                channel.respond({'id': id, 'result': {'msg': 'Invalid token'}, 'error': True})
+                return
+            since = int(kwargs.get('since_version') or 0)
+            timeout = min(float(kwargs.get('timeout') or DEFAULT_TIMEOUT), MAX_TIMEOUT)
+            result = server.waitForChange(id=id, uid=uid, since_version=since)
+        except Exception, e:
+            channel.respond({'id': id, 'result': {'msg': str(e)}, 'error': True})
+            return
+        finally:
+            server.end_request()
+        if result['result']['changed'] or timeout <= 0:
+            channel.respond(result)
+        else:
+            self.waiters[channel] = (id, uid, since, time.time() + timeout)
+
+    def check(self):
+        if not self.waiters:
+            return
+        try:
+            versions = server.data_versions(set([w[1] for w in self.waiters.values()]))
+        except Exception, e:
+            # The loop must go on: the waiters are answered and may retry.
+            traceback.print_exc()
+            for channel, (id, uid, since, deadline) in self.waiters.items():
+                channel.respond({'id': id, 'result': {'msg': str(e)}, 'error': True})
+            self.waiters.clear()
+            return
+        finally:
+            server.end_request()
+        now = time.time()
+        for channel, (id, uid, since, deadline) in self.waiters.items():
+            version = versions[uid]
+            if version > since or now >= deadline:
+                del self.waiters[channel]
+                channel.respond({'id': id, 'error': False,
+                                 'result': {'version': version, 'changed': version > since}})
+
+    def serve_forever(self):
+        last = 0
+        while True:
+            asyncore.loop(timeout=POLL_INTERVAL, map=self.map, count=1)
+            if time.time() - last >= POLL_INTERVAL:
+                self.check()
+                last = time.time()
+
+def serve(host=HOST, port=PORT):
+    server.setup()
+    pollserver = PollServer(host, port)
+    print "Long-poll server on %s:%d..." % (host or '0.0.0.0', port)
+    try:
+        pollserver.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-H", "--host", default=HOST,
+                      help="interface to listen on (default: all)")
+    parser.add_option("-p", "--port", type="int", default=PORT,
+                      help="port to listen on (default: %default)")
+    options, args = parser.parse_args()
+    serve(options.host, options.port)
@@ -0,0 +1,280 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import sys, os
+import cgi as cgimodule
+import urllib
+import zlib
+import socket
+import threading
+from optparse import OptionParser
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler, \
+     ServerHandler
+
+curdir = os.path.join(os.path.dirname(__file__))
+site_packages = os.path.join(curdir,'..', 'site_packages')
+if site_packages not in sys.path:
+    sys.path.insert(0, site_packages)
+if curdir not in sys.path:
+    sys.path.insert(0, curdir)
+
+import simplejson as json
+import functions as server
+import ttpoll
+
+HOST = ''
+PORT = 8080
+# Responses shorter than this are sent uncompressed even to gzip clients.
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+# Seconds an idle keep-alive connection is kept open waiting for the next
+# request.
+KEEPALIVE_TIMEOUT = 15
+# Port of the long-poll server started by serve(), to which waitForChange
+# calls are redirected; None when there is none, e.g. under CGI, and the
+# call then answers at once.
+poll_port = None
+# Base URL of the long-poll server given to clients instead, e.g. when it is
+# behind a proxy or served apart from this server.
+poll_url = None
+
+def parse_get_qs(qs, fs, keep_blank_values=0, strict_parsing=0):
+    r = {}
+    for name_value in qs.split('&'):
+        nv = name_value.split('=', 2)
+        if len(nv) != 2:
+            if strict_parsing:
+                raise ValueError, "bad query field: %r" % (name_value,)
+            continue
+        name = urllib.unquote(nv[0].replace('+', ' '))
+        value = urllib.unquote(nv[1].replace('+', ' '))
+        if len(value) or keep_blank_values:
+            if r.has_key(name):
+                r[name].append(value)
+            else:
+                r[name] = [value]
+
+    # Only append values that aren't already in the FieldStorage's keys;
+    # This makes POSTed vars override vars on the query string
+    for key, values in r.items():
+        if not fs.has_key(key):
+            for value in values:
+                fs.list.append(cgimodule.MiniFieldStorage(key, value))
+    return fs
+
+def read_batch(environ):
+    """Return the list of calls POSTed as a JSON array, or None when the
+    request is an ordinary single call."""
+    if environ.get('REQUEST_METHOD') != 'POST' or \
+       not environ.get('CONTENT_TYPE', '').startswith('application/json'):
+        return None
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    calls = json.loads(environ['wsgi.input'].read(length))
+    if type(calls) == dict:
+        calls = [calls]
+    return calls
+
+def read_params(environ):
+    params = cgimodule.FieldStorage(fp=environ['wsgi.input'], environ=environ,
+                                    keep_blank_values=1)
+    params = parse_get_qs(environ.get('QUERY_STRING', ''), params)
+
+    kwargs = {}
+    for p in params:
+        try:
+            kwargs[p] = params[p].value
+        except:
+            kwargs[p] = [l.value for l in params[p]]
+    return kwargs
+
+def poll_location(environ):
+    """URL of the long-poll server for the waitForChange call of the
+    request: poll_url, or poll_port on the host and scheme of the request."""
+    query = environ.get('QUERY_STRING', '')
+    if poll_url:
+        return '%s?%s' % (poll_url, query)
+    host = environ.get('HTTP_HOST', environ.get('SERVER_NAME', ''))
+    if host.startswith('['):
+        # An IPv6 address.
+        host = host[:host.find(']') + 1]
+    else:
+        host = host.split(':')[0]
+    return '%s://%s:%d/?%s' % (environ.get('wsgi.url_scheme', 'http'), host,
+                               poll_port, query)
+
+def error_response(kwargs, msg):
+    return '200 OK', [('Content-Type', 'application/json')], \
+           json.dumps({'id': kwargs.get('id', 0), 'error': True, 'result': {'msg': msg}})
+
+def dispatch(environ):
+    """Run the call described by the request, returning the status, the
+    headers and the body of the response."""
+    calls = read_batch(environ)
+    if calls is not None:
+        return '200 OK', [('Content-Type', 'application/json')], \
+               json.dumps(server.batch(calls))
+
+    kwargs = read_params(environ)
+    action = kwargs.pop('method', None)
+    output = kwargs.get('output', 'json')
+
+    if action == 'waitForChange' and (poll_url or poll_port):
+        return '307 Temporary Redirect', [('Location', poll_location(environ))], ''
+    if action == 'exportLogs':
+        # Not an rpccall, so the user of its token is resolved here.
+        uid = server.request_user(kwargs)
+        if 'token' in kwargs and uid is None:
+            return error_response(kwargs, 'Invalid token')
+        kwargs.pop('token', None)
+        kwargs['uid'] = uid
+        format = kwargs.get('format', 'csv')
+        if format not in server.EXPORT_FORMATS:
+            return error_response(kwargs, 'Unknown format %s' % format)
+        return '200 OK', [('Content-Type', server.EXPORT_FORMATS[format])], \
+               server.exportLogs(**kwargs)
+    if action in server.METHODS:
+        f = getattr(server, action)
+        if output=='json':
+            headers = [('Content-Type', 'application/json')]
+            if action in server.CONDITIONAL_METHODS:
+                uid = server.request_user(kwargs)
+                if uid is not None:
+                    # Read before the data, so that a concurrent change can
+                    # only make the tag older than the body, never newer.
+                    etag = '"%d-%x"' % (uid, server.data_version(uid))
+                    if etag in environ.get('HTTP_IF_NONE_MATCH', '').split(', '):
+                        return '304 Not Modified', [('ETag', etag)], ''
+                    headers.append(('ETag', etag))
+            return '200 OK', headers, json.dumps(f(**kwargs))
+        return '200 OK', [('Content-Type', 'text/plain')], str(f(**kwargs))
+    return '200 OK', [('Content-Type', 'text/plain')], "Default Screen"
+
+def accepts_gzip(environ):
+    return 'gzip' in environ.get('HTTP_ACCEPT_ENCODING', '')
+
+def gzip_compressor():
+    # wbits=31 makes zlib write the gzip header and trailer.
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+def gzip_chunks(chunks):
+    compressor = gzip_compressor()
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+class StreamedResponse(object):
+    """Response body produced by a generator while the request still owns
+    its session; the request ends when the server closes the body."""
+    def __init__(self, chunks, compress=False):
+        self.chunks = chunks
+        self.compress = compress
+
+    def __iter__(self):
+        if self.compress:
+            return gzip_chunks(self.chunks)
+        return self.chunks
+
+    def close(self):
+        try:
+            self.chunks.close()
+        finally:
+            server.end_request()
+
+def application(environ, start_response):
+    try:
+        status, headers, body = dispatch(environ)
+    except:
+        server.end_request()
+        raise
+    compress = accepts_gzip(environ)
+    if not isinstance(body, str):
+        if compress:
+            headers = headers + [('Content-Encoding', 'gzip'), ('Vary', 'Accept-Encoding')]
+        start_response(status, headers)
+        return StreamedResponse(body, compress)
+    server.end_request()
+    if compress and len(body) >= GZIP_MIN_SIZE:
+        compressor = gzip_compressor()
+        body = compressor.compress(body) + compressor.flush()
+        headers = headers + [('Content-Encoding', 'gzip')]
+    if status[:3] != '304':
+        headers = headers + [('Vary', 'Accept-Encoding'),
+                             ('Content-Length', str(len(body)))]
+    start_response(status, headers)
+    return [body]
+
+class KeepAliveHandler(ServerHandler):
+    http_version = '1.1'
+    keep_alive = True
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        # Without a length the end of the body is the end of the connection.
+        if 'Content-Length' not in self.headers and self.status[:3] not in ('204', '304'):
+            self.headers['Connection'] = 'close'
+            self.keep_alive = False
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """Serve the requests of a connection in turn until the client closes
+    it, asks to, or stays idle for KEEPALIVE_TIMEOUT seconds."""
+    protocol_version = 'HTTP/1.1'
+    timeout = KEEPALIVE_TIMEOUT
+    # Headers and body are written separately: with Nagle the body would
+    # wait for the client's delayed ACK of the headers.
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        while True:
+            try:
+                self.raw_requestline = self.rfile.readline(65537)
+            except socket.timeout:
+                return
+            if not self.raw_requestline or len(self.raw_requestline) > 65536:
+                return
+            if not self.parse_request():
+                return
+            handler = KeepAliveHandler(
+                self.rfile, self.wfile, self.get_stderr(), self.get_environ())
+            handler.request_handler = self
+            handler.run(self.server.get_app())
+            if self.close_connection or not handler.keep_alive:
+                return
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+def serve(host=HOST, port=PORT, pollport=ttpoll.PORT, pollurl=None):
+    global poll_port, poll_url
+    server.setup()
+    poll_url = pollurl
+    if pollport:
+        pollserver = ttpoll.PollServer(host, pollport)
+        thread = threading.Thread(target=pollserver.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        poll_port = pollport
+        print "Long-poll server on %s:%d..." % (host or '0.0.0.0', pollport)
+    httpd = make_server(host, port, application, server_class=ThreadingWSGIServer,
+                        handler_class=KeepAliveRequestHandler)
+    print "Serving on %s:%d..." % (host or '0.0.0.0', port)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-H", "--host", default=HOST,
+                      help="interface to listen on (default: all)")
+    parser.add_option("-p", "--port", type="int", default=PORT,
+                      help="port to listen on (default: %default)")
+    parser.add_option("-P", "--poll-port", type="int", default=ttpoll.PORT,
+                      help="port of the long-poll server, 0 for none (default: %default)")
+    parser.add_option("-U", "--poll-url",
+                      help="URL of the long-poll server given to clients "
+                           "(default: the poll port on the requested host)")
+    options, args = parser.parse_args()
+    serve(options.host, options.port, options.poll_port, options.poll_url)
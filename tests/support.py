@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+# Shared by the tests, run from the top directory with:
+#   python -m unittest discover -s tests
+
+import os, sys
+import atexit
+import shutil
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'application'))
+
+import functions
+import ttpoll
+
+TABLES = ['currentstatus', 'dailytotal', 'requestkey', 'activitylog',
+          'activitylog_deleted', 'activity', 'userversion', 'user']
+
+def setup_database():
+    """Point functions, which keeps one engine per process, at a scratch
+    database removed at exit."""
+    if functions.session is not None:
+        return
+    tmpdir = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, tmpdir)
+    functions.DATABASE = os.path.join(tmpdir, 'timetracker.db')
+    functions.SECRET_FILE = os.path.join(tmpdir, 'secret.key')
+    functions.setup()
+
+_poll_port = None
+
+def start_poll_server():
+    """Start a long-poll server answered by a daemon thread for the whole
+    run, shared by the tests, and return its port."""
+    global _poll_port
+    if _poll_port is None:
+        pollserver = ttpoll.PollServer('127.0.0.1', 0)
+        _poll_port = pollserver.socket.getsockname()[1]
+        start_thread(pollserver.serve_forever)
+    return _poll_port
+
+def start_thread(target):
+    def run():
+        try:
+            target()
+        except:
+            # Raised at exit, as the modules are torn down under the
+            # daemon thread.
+            pass
+    thread = threading.Thread(target=run)
+    thread.setDaemon(True)
+    thread.start()
+
+def clear_database():
+    conn = functions.engine.connect()
+    for table in TABLES:
+        conn.execute("DELETE FROM %s" % table)
+    conn.close()
+
+def result(response):
+    assert not response['error'], response
+    return response['result']
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from support import functions, setup_database, clear_database, result
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql.expression import Select
+
+class FunctionsTest(unittest.TestCase):
+    def setUp(self):
+        setup_database()
+        clear_database()
+
+class SetupTest(FunctionsTest):
+    def test_retry_after_failed_migration(self):
+        saved = functions.engine, functions.session, functions.migrate
+        def locked(engine):
+            raise OperationalError(
+                'BEGIN EXCLUSIVE', {}, Exception('database is locked'))
+        functions.engine = functions.session = None
+        functions.migrate = locked
+        try:
+            self.assertRaises(OperationalError, functions.getStatus)
+            self.assertEqual(functions.engine, None)
+            functions.migrate = saved[2]
+            self.assertEqual(result(functions.getStatus())['name'], 'none')
+            functions.engine.dispose()
+        finally:
+            functions.engine, functions.session, functions.migrate = saved
+
+class LoadTest(FunctionsTest):
+    def test_without_key(self):
+        self.assertEqual(functions.User.load(functions.session, id=None), None)
+        functions.end_request()
+        response = functions.changePassword(pwd='secret', newpwd='other')
+        self.assertTrue(response['error'])
+
+class StatusTest(FunctionsTest):
+    def test_without_uid(self):
+        # The GUI and the script send no uid.
+        uid = result(functions.addUser(uname='alice', pwd='secret'))['uid']
+        result(functions.startActivity(uid=uid, name='work'))
+        result(functions.startActivity(name='coding'))
+        self.assertEqual(result(functions.getStatus())['name'], 'coding')
+        self.assertEqual(result(functions.getStatus(uid=uid))['name'], 'work')
+        stopped = result(functions.stopActivity(descr='done'))
+        self.assertEqual(stopped['msg'], 'Activity coding (done) stopped!')
+        self.assertEqual(result(functions.getStatus())['name'], 'none')
+        self.assertEqual(result(functions.getStatus(uid=uid))['name'], 'work')
+        self.assertTrue(functions.stopActivity()['error'])
+        totals = result(functions.getSummary(group_by='activity'))['totals']
+        self.assertEqual([row[1] for row in totals], ['coding'])
+        self.assertEqual(result(functions.getSummary(uid=uid))['totals'], [])
+
+    def test_restart_without_uid(self):
+        result(functions.startActivity(name='coding'))
+        result(functions.startActivity(name='reading'))
+        self.assertEqual(result(functions.getStatus())['name'], 'reading')
+        result(functions.stopActivity())
+        self.assertEqual(result(functions.getStatus())['name'], 'none')
+
+class TotalsTest(FunctionsTest):
+    """The daily totals kept by each RPC equal those rebuilt from the logs."""
+    def totals(self):
+        conn = functions.engine.connect()
+        try:
+            return sorted(map(tuple, conn.execute("SELECT user_id, activity_id, day, "
+                                                  "round(seconds, 3) FROM dailytotal")))
+        finally:
+            conn.close()
+
+    def assertTotals(self):
+        totals = self.totals()
+        functions.rebuildDailyTotals()
+        functions.end_request()
+        self.assertEqual(totals, self.totals())
+
+    def log_ids(self, uid):
+        conn = functions.engine.connect()
+        try:
+            return [id for (id,) in conn.execute(
+                "SELECT id FROM activitylog WHERE user_id IS ? ORDER BY id", uid)]
+        finally:
+            conn.close()
+
+    def check_user(self, uid, prefix):
+        work, play = prefix + 'work', prefix + 'play'
+        imported = result(functions.importLogs(uid=uid, rows=[
+            [work, 'night', '01/03/2012 22:30:00', '02/03/2012 01:15:00'],
+            [work, 'day', '02/03/2012 09:00:00', '02/03/2012 12:00:00'],
+            [play, 'days', '03/03/2012 20:00:00', '05/03/2012 08:00:00'],
+            [play, 'short', '05/03/2012 10:00:00', '05/03/2012 10:20:00'],
+            [work, 'more', '06/03/2012 10:00:00', '06/03/2012 11:00:00']]))
+        self.assertEqual(imported['imported'], 5)
+        self.assertTotals()
+        result(functions.startActivity(uid=uid, name=work))
+        result(functions.stopActivity(uid=uid, descr='now'))
+        self.assertTotals()
+        first, second, third, fourth, fifth, current = self.log_ids(uid)
+        result(functions.editItem(uid=uid, index=first, activity_name=play,
+                                  description='moved', date_start='01/03/2012 23:00:00',
+                                  date_stop='02/03/2012 02:00:00'))
+        self.assertTotals()
+        result(functions.deleteItem(uid=uid, index=second))
+        self.assertTotals()
+        modified = result(functions.editItems(uid=uid, changes=[
+            {'index': third, 'date_stop': '04/03/2012 06:00:00'},
+            {'index': fourth, 'activity_name': work},
+            {'index': current, 'date_start': '28/02/2012 23:59:00',
+             'date_stop': '29/02/2012 00:01:00'}]))
+        self.assertEqual(modified['modified'], 3)
+        self.assertTotals()
+        self.assertEqual(result(functions.deleteItems(uid=uid, indices=[first, fifth]))['deleted'], 2)
+        self.assertTotals()
+
+    def test_user(self):
+        uid = result(functions.addUser(uname='alice', pwd='secret'))['uid']
+        self.check_user(uid, 'alice ')
+
+    def test_without_uid(self):
+        self.check_user(None, '')
+
+class DateTest(FunctionsTest):
+    def test_invalid_dates(self):
+        for method in (functions.getLogs, functions.getLogsByDate, functions.getSummary):
+            for dates in ({'from': '99/99/2012'}, {'to': '2012-03-01'}, {'from': ['a', 'b']}):
+                response = method(**dates)
+                self.assertTrue(response['error'])
+                self.assertEqual(response['result']['msg'], 'Invalid date')
+        self.assertEqual(result(functions.getLogs(**{'from': '01/03/2012'})), {})
+
+class PlanTest(FunctionsTest):
+    """The queries of the RPCs read through the indexes meant for them."""
+    def plans(self, method, **kwargs):
+        """Return the EXPLAIN QUERY PLAN details of the SELECTs run by the
+        RPC, one string per query."""
+        statements = []
+        execute = functions.session.execute
+        def record(clause, *args, **kw):
+            statements.append(clause)
+            return execute(clause, *args, **kw)
+        functions.session.execute = record
+        try:
+            result(method(**kwargs))
+        finally:
+            del functions.session.execute
+        plans = []
+        for statement in statements:
+            if not isinstance(statement, Select):
+                continue
+            compiled = statement.compile(bind=functions.engine)
+            params = [compiled.params[key] for key in compiled.positiontup]
+            plans.append(' / '.join([row[3] for row in functions.engine.execute(
+                "EXPLAIN QUERY PLAN " + str(compiled), *params)]))
+        return plans
+
+    def test_logs_since(self):
+        uid = result(functions.addUser(uname='alice', pwd='secret'))['uid']
+        result(functions.startActivity(uid=uid, name='work'))
+        result(functions.stopActivity(uid=uid))
+        plans = self.plans(functions.getLogsSince, uid=uid, cursor='1')
+        self.assertTrue([plan for plan in plans if 'activitylog USING INDEX '
+                         'ix_activitylog_user_version (user_id=? AND version>?' in plan], plans)
+
+    def test_summary(self):
+        uid = result(functions.addUser(uname='alice', pwd='secret'))['uid']
+        result(functions.startActivity(uid=uid, name='work'))
+        result(functions.stopActivity(uid=uid))
+        plans = self.plans(functions.getSummary, uid=uid, granularity='week',
+                           **{'from': '01/03/2012', 'to': '31/03/2012'})
+        self.assertTrue([plan for plan in plans if 'dailytotal USING ' in plan and
+                         '(user_id=? AND day>? AND day<?)' in plan], plans)
+
+class IdempotencyTest(FunctionsTest):
+    def test_replay_without_uid(self):
+        first = result(functions.startActivity(name='coding', idempotency_key='k1'))
+        self.assertEqual(result(functions.startActivity(name='coding', idempotency_key='k1')),
+                         first)
+        conn = functions.engine.connect()
+        self.assertEqual(conn.execute("SELECT count(*) FROM activitylog").scalar(), 1)
+        conn.close()
+
+class VersionTest(FunctionsTest):
+    def test_without_uid(self):
+        uid = result(functions.addUser(uname='alice', pwd='secret'))['uid']
+        result(functions.startActivity(uid=uid, name='work'))
+        version = functions.data_version(uid)
+        before = functions.data_version(None)
+        result(functions.startActivity(name='coding'))
+        result(functions.stopActivity())
+        self.assertTrue(functions.data_version(None) > before)
+        self.assertEqual(functions.data_version(uid), version)
+        self.assertTrue(result(functions.waitForChange(since_version=before))['changed'])
+        conn = functions.engine.connect()
+        self.assertEqual(sorted(uid for (uid,) in conn.execute("SELECT user_id FROM userversion")),
+                         [functions.NO_USER, uid])
+        conn.close()
+
+if __name__ == '__main__':
+    unittest.main()
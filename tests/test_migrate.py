@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os, sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'application'))
+
+import functions
+from sqlalchemy import create_engine
+
+# The database shipped with the application, as created by its first
+# release (schema version 0).
+BASELINE_DB = os.path.join(os.path.dirname(os.path.abspath(functions.__file__)),
+                           'timetracker.db')
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'timetracker.db')
+        shutil.copy(BASELINE_DB, self.path)
+        self.engines = []
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.dispose()
+        shutil.rmtree(self.dir)
+
+    def connect(self):
+        engine = create_engine('sqlite:///%s' % self.path)
+        self.engines.append(engine)
+        return engine.connect()
+
+    def migrate(self):
+        conn = self.connect()
+        functions.migrate(conn.engine)
+        return conn
+
+    def user_version(self, conn):
+        return conn.execute("PRAGMA user_version").scalar()
+
+    def stamp(self, conn, step):
+        """Set the schema version to the one before `step`."""
+        conn.execute("PRAGMA user_version = %d" % functions.MIGRATIONS.index(step))
+
+    def daily_totals(self, conn):
+        return sorted(map(tuple, conn.execute("SELECT user_id, activity_id, day, "
+                                              "round(seconds, 3) FROM dailytotal")))
+
+    def test_baseline_database(self):
+        conn = self.migrate()
+        self.assertEqual(self.user_version(conn), functions.SCHEMA_VERSION)
+        self.assertEqual(conn.execute("SELECT count(*) FROM activitylog "
+                                      "WHERE version IS NULL").scalar(), 0)
+        self.assertTrue(conn.execute("SELECT version FROM syncversion").scalar() >=
+                        conn.execute("SELECT max(version) FROM activitylog").scalar())
+        running = conn.execute("SELECT id, user_id FROM activitylog "
+                               "WHERE is_completed = 0").fetchall()
+        self.assertEqual(conn.execute("SELECT log_id, user_id FROM currentstatus").fetchall(),
+                         running)
+        totals = self.daily_totals(conn)
+        self.assertTrue(totals)
+        functions._rebuild_daily_totals(conn)
+        self.assertEqual(self.daily_totals(conn), totals)
+
+    def test_new_database(self):
+        os.remove(self.path)
+        conn = self.migrate()
+        self.assertEqual(self.user_version(conn), functions.SCHEMA_VERSION)
+        self.assertEqual(conn.execute("SELECT count(*) FROM syncversion").scalar(), 1)
+
+    def test_schema_without_stamp(self):
+        # An upgrade interrupted before its stamp, or raced by another
+        # process, leaves the schema ahead of user_version.
+        conn = self.migrate()
+        versions = conn.execute("SELECT id, version FROM activitylog").fetchall()
+        conn.execute("PRAGMA user_version = 0")
+        conn.close()
+        conn = self.migrate()
+        self.assertEqual(self.user_version(conn), functions.SCHEMA_VERSION)
+        self.assertEqual(conn.execute("SELECT id, version FROM activitylog").fetchall(),
+                         versions)
+
+    def test_half_applied_step(self):
+        conn = self.connect()
+        conn.execute("ALTER TABLE activitylog ADD COLUMN version INTEGER")
+        conn.close()
+        conn = self.migrate()
+        self.assertEqual(self.user_version(conn), functions.SCHEMA_VERSION)
+        self.assertEqual(conn.execute("SELECT count(*) FROM activitylog "
+                                      "WHERE version IS NULL").scalar(), 0)
+
+    def test_status_without_user(self):
+        # Status rows of logs without a user used to get a rowid of their own.
+        conn = self.migrate()
+        conn.execute("UPDATE activitylog SET is_completed = 1")
+        conn.execute("INSERT INTO activitylog (activity_id, is_completed, date_start) "
+                     "SELECT min(id), 0, '2011-10-20 09:00:00' FROM activity")
+        log_id = conn.execute("SELECT max(id) FROM activitylog").scalar()
+        conn.execute("DELETE FROM currentstatus")
+        conn.execute("INSERT INTO currentstatus (log_id, activity_name, date_start) "
+                     "VALUES (?, 'orphan', '2011-10-20 09:00:00')", log_id)
+        self.stamp(conn, functions._migrate_status_keys)
+        conn.close()
+        conn = self.migrate()
+        self.assertEqual(map(tuple, conn.execute("SELECT user_id, log_id FROM currentstatus")),
+                         [(functions.NO_USER, log_id)])
+
+    def test_versions_without_user(self):
+        conn = self.migrate()
+        for name in ('insert', 'update', 'delete'):
+            conn.execute("DROP TRIGGER activitylog_version_%s" % name)
+        conn.execute("DELETE FROM userversion")
+        # Phantom rows left by the triggers for logs without a user.
+        conn.execute("INSERT INTO userversion (user_id, version) VALUES (NULL, 1)")
+        conn.execute("INSERT INTO userversion (user_id, version) VALUES (NULL, 2)")
+        self.stamp(conn, functions._migrate_version_keys)
+        conn.close()
+        conn = self.migrate()
+        users = set(user_id for (user_id,) in conn.execute(
+            "SELECT coalesce(user_id, 0) FROM activitylog UNION "
+            "SELECT coalesce(user_id, 0) FROM activity"))
+        self.assertEqual(set(user_id for (user_id,) in conn.execute(
+            "SELECT user_id FROM userversion")), users)
+        syncversion = conn.execute("SELECT version FROM syncversion").scalar()
+        conn.execute("INSERT INTO activitylog (activity_id, is_completed) "
+                     "SELECT min(id), 0 FROM activity")
+        self.assertEqual(conn.execute("SELECT version FROM userversion WHERE user_id = ?",
+                                      functions.NO_USER).scalar(), syncversion + 1)
+
+    def test_daily_total_key(self):
+        conn = self.migrate()
+        totals = self.daily_totals(conn)
+        conn.execute("DROP TABLE dailytotal")
+        # As created by the release that added the totals.
+        conn.execute("""CREATE TABLE dailytotal (
+            user_id INTEGER NOT NULL, activity_id INTEGER NOT NULL,
+            day DATE NOT NULL, seconds FLOAT NOT NULL,
+            PRIMARY KEY (user_id, activity_id, day))""")
+        functions._rebuild_daily_totals(conn)
+        self.stamp(conn, functions._migrate_daily_total_key)
+        conn.close()
+        conn = self.migrate()
+        self.assertEqual(self.daily_totals(conn), totals)
+        key = sorted([(row[5], row[1]) for row in conn.execute("PRAGMA table_info(dailytotal)")
+                      if row[5]])
+        self.assertEqual([name for pk, name in key], ['user_id', 'day', 'activity_id'])
+
+    def test_failed_step_is_rolled_back(self):
+        def fail(conn):
+            conn.execute("UPDATE activitylog SET description = 'lost'")
+            raise RuntimeError('step failed')
+        migrations = functions.MIGRATIONS[:]
+        functions.MIGRATIONS[1] = fail
+        try:
+            self.assertRaises(RuntimeError, self.migrate)
+        finally:
+            functions.MIGRATIONS[:] = migrations
+        conn = self.connect()
+        self.assertEqual(self.user_version(conn), 1)
+        self.assertEqual(conn.execute("SELECT count(*) FROM activitylog "
+                                      "WHERE description = 'lost'").scalar(), 0)
+        conn = self.migrate()
+        self.assertEqual(self.user_version(conn), functions.SCHEMA_VERSION)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os, sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'application'))
+
+from replica import Replica
+
+IDLE = {'name': 'none', 'start': ''}
+
+class ReplicaTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.replica = Replica(os.path.join(self.dir, 'replica.db'))
+
+    def tearDown(self):
+        self.replica.close()
+        shutil.rmtree(self.dir)
+
+    def test_reads_by_user(self):
+        replica = self.replica
+        replica.put('getStatus', {'token': 'alice'}, IDLE, replica.generation)
+        replica.put('getStatus', {'token': 'bob'}, IDLE, replica.generation)
+        self.assertEqual(replica.get('getStatus', {'token': 'carol'}), None)
+        self.assertEqual(replica.get('getStatus', {'token': 'alice', 'id': 3}), IDLE)
+        replica.queue('startActivity', {'token': 'bob', 'name': 'work'})
+        self.assertEqual(replica.get('getStatus', {'token': 'alice'}), IDLE)
+        self.assertEqual(replica.get('getStatus', {'token': 'bob'})['name'], 'work')
+
+    def test_drop(self):
+        replica = self.replica
+        replica.put('getStatus', {'token': 'alice'}, IDLE, replica.generation)
+        replica.drop('getStatus', {'token': 'alice'})
+        self.assertEqual(replica.stored_reads(), [])
+
+    def test_racing_read(self):
+        # A read sent before a queued call, answered after it, would hide
+        # the call.
+        replica = self.replica
+        replica.put('getStatus', {}, IDLE, replica.generation)
+        generation = replica.generation
+        replica.queue('startActivity', {'name': 'work'})
+        seq = replica.pending()[0][0]
+        replica.done(seq)
+        replica.put('getStatus', {}, IDLE, generation)
+        self.assertEqual(replica.get('getStatus', {})['name'], 'work')
+
+    def test_pending_journal(self):
+        # The server has not seen the queued call yet.
+        replica = self.replica
+        replica.put('getStatus', {}, IDLE, replica.generation)
+        replica.queue('startActivity', {'name': 'work'})
+        replica.put('getStatus', {}, IDLE, replica.generation)
+        self.assertEqual(replica.get('getStatus', {})['name'], 'work')
+        replica.done(replica.pending()[0][0])
+        replica.put('getStatus', {}, IDLE, replica.generation)
+        self.assertEqual(replica.get('getStatus', {}), IDLE)
+
+    def test_stop(self):
+        replica = self.replica
+        replica.put('getStatus', {}, IDLE, replica.generation)
+        replica.put('getLogs', {}, {}, replica.generation)
+        replica.put('getLogs', {'from': '01/03/2012'}, {}, replica.generation)
+        replica.queue('startActivity', {'name': 'work', 'at': '01/03/2012 09:00:00'})
+        response = replica.queue('stopActivity', {'descr': 'done', 'at': '01/03/2012 10:30:00'})
+        self.assertEqual(response['msg'], 'Activity work (done) stopped!')
+        self.assertEqual(replica.get('getStatus', {}), IDLE)
+        self.assertEqual(replica.get('getLogs', {}),
+                         {'work': {'01/03/2012': [[None, 'done', '1:30:00', '09:00', '10:30']]}})
+        self.assertEqual(replica.get('getLogs', {'from': '01/03/2012'}), {})
+        self.assertEqual([method for seq, key, method, params in replica.pending()],
+                         ['startActivity', 'stopActivity'])
+
+    def test_failed_queue(self):
+        replica = self.replica
+        replica.put('getStatus', {}, IDLE, replica.generation)
+        replica.queue('startActivity', {'name': 'work'})
+        self.assertRaises(ValueError, replica.queue, 'stopActivity', {'at': 'now'})
+        self.assertEqual(len(replica.pending()), 1)
+        self.assertEqual(replica.get('getStatus', {})['name'], 'work')
+
+if __name__ == '__main__':
+    unittest.main()
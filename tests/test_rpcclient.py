@@ -0,0 +1,259 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from StringIO import StringIO
+from wsgiref.simple_server import make_server
+
+from support import functions, setup_database, clear_database, start_poll_server, \
+     start_thread
+import simplejson as json
+import ttwsgi
+from replica import Replica
+from rpcclient import rpcClient, ResponseCache, ETagCache, GzipReader, Result, \
+     read_response
+
+# Seconds the test server keeps an idle connection, much less than the
+# IDLE_TIMEOUT of the client, so that a pooled connection can go stale.
+KEEPALIVE_TIMEOUT = 0.3
+
+class RequestHandler(ttwsgi.KeepAliveRequestHandler):
+    timeout = KEEPALIVE_TIMEOUT
+
+    def log_message(self, format, *args):
+        pass
+
+def result(response):
+    assert not response.error, response
+    return response.result
+
+def setUpModule():
+    global url, netloc, poll_port
+    setup_database()
+    poll_port = start_poll_server()
+    # On a port of its own, answered by a daemon thread for the whole run.
+    httpd = make_server('127.0.0.1', 0, ttwsgi.application,
+                        server_class=ttwsgi.ThreadingWSGIServer,
+                        handler_class=RequestHandler)
+    netloc = '127.0.0.1:%d' % httpd.server_port
+    url = 'http://%s/' % netloc
+    start_thread(httpd.serve_forever)
+
+class ClientTest(unittest.TestCase):
+    def setUp(self):
+        clear_database()
+        self.client = rpcClient(url, retries=0)
+
+    def tearDown(self):
+        self.client.close()
+
+    def connections(self, method):
+        return self.client.stats()[method]['connections']
+
+class ConnectionPoolTest(ClientTest):
+    def test_reuse(self):
+        for i in range(3):
+            self.assertEqual(result(self.client.getStatus())['name'], 'none')
+        self.assertEqual(self.connections('getStatus'), 1)
+        self.assertEqual(len(self.client.pool.idle[('http', netloc)]), 1)
+
+    def test_stale_connection(self):
+        result(self.client.getStatus())
+        time.sleep(KEEPALIVE_TIMEOUT * 3)
+        # Closed by the server, yet still idle in the pool: sent again on
+        # a new connection, even when the call is not a read.
+        self.assertEqual(result(self.client.startActivity(name='work'))['msg'],
+                         'Activity work started!')
+        time.sleep(KEEPALIVE_TIMEOUT * 3)
+        self.assertEqual(result(self.client.getStatus())['name'], 'work')
+        self.assertEqual(self.connections('getStatus') + self.connections('startActivity'), 3)
+        self.assertEqual(self.client.stats()['getStatus']['errors'], 0)
+
+    def test_release_after_redirect(self):
+        saved = ttwsgi.poll_port
+        ttwsgi.poll_port = poll_port
+        try:
+            version = functions.data_version(None)
+            functions.end_request()
+            response = self.client.waitForChange(since_version=version - 1, timeout=1)
+        finally:
+            ttwsgi.poll_port = saved
+        self.assertEqual(result(response)['changed'], True)
+        # The redirected connection is back in the pool, once.
+        self.assertEqual(len(self.client.pool.idle[('http', netloc)]), 1)
+        result(self.client.getStatus())
+        self.assertEqual(self.connections('getStatus'), 0)
+
+class ETagTest(ClientTest):
+    def setUp(self):
+        ClientTest.setUp(self)
+        result(self.client.addUser(uname='alice', pwd='secret'))
+        result(self.client.authUser(uname='alice', pwd='secret'))
+        result(self.client.startActivity(name='work'))
+        result(self.client.stopActivity(descr='done'))
+
+    def test_not_modified(self):
+        first = result(self.client.getLogs())
+        received = self.client.stats()['getLogs']['response_bytes']
+        first['work'] = None
+        second = result(self.client.getLogs())
+        # A 304 without a body, answered with a copy of the first result.
+        self.assertEqual(self.client.stats()['getLogs']['response_bytes'], received)
+        self.assertEqual(second.keys(), ['work'])
+        self.assertEqual(result(self.client.getLogs()), second)
+        result(self.client.startActivity(name='work'))
+        result(self.client.stopActivity(descr='again'))
+        self.assertEqual(len(result(self.client.getLogs())['work'].values()[0]), 2)
+
+    def test_lru(self):
+        etags = ETagCache(size=2)
+        etags.add('a', '"1"', {'n': 1})
+        etags.add('b', '"2"', {'n': 2})
+        etags.get('a')
+        etags.add('c', '"3"', {'n': 3})
+        self.assertEqual(etags.get('b'), None)
+        self.assertEqual(etags.get('a'), ('"1"', json.dumps({'n': 1})))
+        self.assertEqual(etags.get('c')[0], '"3"')
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache(size=2, ttls={'getStatus': 60, 'getLogs': 60,
+                                                 'getActivities': 0})
+
+    def add(self, method, params, value, epoch=None):
+        if epoch is None:
+            epoch = self.cache.epoch
+        self.cache.add(method, params, Result(id=1, result=value, error=False), epoch)
+
+    def test_get(self):
+        self.add('getStatus', {'uid': 1, 'id': 4}, {'name': 'work'})
+        cached = self.cache.get('getStatus', {'uid': '1', 'id': 5})
+        self.assertEqual(cached.result, {'name': 'work'})
+        cached.result['name'] = 'changed'
+        self.assertEqual(self.cache.get('getStatus', {'uid': 1}).result, {'name': 'work'})
+        self.assertEqual(self.cache.get('getStatus', {'uid': 2}), None)
+        self.add('getActivities', {}, ['work'])
+        self.assertEqual(self.cache.get('getActivities', {}), None)
+
+    def test_lru(self):
+        self.add('getStatus', {'uid': 1}, 1)
+        self.add('getStatus', {'uid': 2}, 2)
+        self.cache.get('getStatus', {'uid': 1})
+        self.add('getStatus', {'uid': 3}, 3)
+        self.assertEqual(self.cache.get('getStatus', {'uid': 2}), None)
+        self.assertEqual(self.cache.get('getStatus', {'uid': 1}).result, 1)
+
+    def test_invalidate(self):
+        self.add('getStatus', {}, {'name': 'none'})
+        self.add('getLogs', {}, {})
+        self.cache.invalidate('startActivity')
+        self.assertEqual(self.cache.get('getStatus', {}), None)
+        self.assertEqual(self.cache.get('getLogs', {}).result, {})
+        # Methods that change nothing cached bump no epoch.
+        epoch = self.cache.epoch
+        self.cache.invalidate('getMethods')
+        self.assertEqual(self.cache.epoch, epoch)
+
+    def test_epoch(self):
+        # A read sent before an invalidation may have missed its change.
+        epoch = self.cache.epoch
+        self.cache.invalidate('stopActivity')
+        self.add('getLogs', {}, {}, epoch)
+        self.assertEqual(self.cache.get('getLogs', {}), None)
+        epoch = self.cache.epoch
+        self.cache.clear()
+        self.add('getLogs', {}, {}, epoch)
+        self.assertEqual(self.cache.get('getLogs', {}), None)
+
+class ClientCacheTest(ClientTest):
+    def setUp(self):
+        ClientTest.setUp(self)
+        self.client.cache = ResponseCache()
+
+    def test_invalidated(self):
+        self.assertEqual(result(self.client.getStatus())['name'], 'none')
+        result(self.client.startActivity(name='work'))
+        self.assertEqual(result(self.client.getStatus())['name'], 'work')
+        self.assertEqual(self.client.stats()['getStatus']['calls'], 2)
+
+    def test_racing_read(self):
+        remote = self.client._remote
+        def racing(method, **kwargs):
+            response = remote(method, **kwargs)
+            if method == 'getStatus':
+                # Answered before, but received after, a change.
+                self.client.startActivity(name='work')
+            return response
+        self.client._remote = racing
+        self.assertEqual(result(self.client.getStatus())['name'], 'none')
+        self.client._remote = remote
+        self.assertEqual(result(self.client.getStatus())['name'], 'work')
+
+class ClientReplicaTest(ClientTest):
+    def setUp(self):
+        ClientTest.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        # Given after the client is made, so that it starts no sync thread:
+        # the tests sync.
+        self.client.replica = Replica(os.path.join(self.dir, 'replica.db'))
+
+    def tearDown(self):
+        self.client.replica.close()
+        shutil.rmtree(self.dir)
+
+    def test_user_switch(self):
+        for name in ('alice', 'bob'):
+            result(self.client.addUser(uname=name, pwd='secret'))
+        result(self.client.authUser(uname='alice', pwd='secret'))
+        self.assertEqual(result(self.client.getStatus())['name'], 'none')
+        self.assertEqual(result(self.client.startActivity(name='work'))['queued'], True)
+        self.assertEqual(result(self.client.getStatus())['name'], 'work')
+        self.assertTrue(self.client.sync())
+        self.assertEqual(self.client.replica.pending(), [])
+        self.assertEqual(result(self.client._remote('getStatus'))['name'], 'work')
+        result(self.client.authUser(uname='bob', pwd='secret'))
+        self.assertEqual(result(self.client.getStatus())['name'], 'none')
+        result(self.client.authUser(uname='alice', pwd='secret'))
+        self.assertEqual(result(self.client.getStatus())['name'], 'work')
+
+    def test_rejected(self):
+        result(self.client.stopActivity())
+        self.assertTrue(self.client.sync())
+        [(seq, method, params, error)] = self.client.rejected_calls()
+        self.assertEqual(method, 'stopActivity')
+        self.client.dismiss_rejected(seq)
+        self.assertEqual(self.client.rejected_calls(), [])
+
+class GzipReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.body = json.dumps([{'id': i, 'name': 'activity %d' % i} for i in range(5000)])
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self.compressed = compressor.compress(self.body) + compressor.flush()
+
+    def test_read(self):
+        self.assertEqual(GzipReader(StringIO(self.compressed)).read(), self.body)
+
+    def test_read_size(self):
+        reader = GzipReader(StringIO(self.compressed))
+        chunks = []
+        while True:
+            chunk = reader.read(1000)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.assertEqual(''.join(chunks), self.body)
+
+    def test_read_response(self):
+        class Response(StringIO):
+            def getheader(self, name, default=None):
+                return {'Content-Encoding': 'gzip'}.get(name, default)
+        self.assertEqual(read_response(Response(self.compressed)), json.loads(self.body))
+
+if __name__ == '__main__':
+    unittest.main()
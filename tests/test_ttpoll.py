@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import httplib
+import threading
+import unittest
+
+from support import functions, setup_database, clear_database, result, \
+     start_poll_server
+import simplejson as json
+
+def setUpModule():
+    global port
+    setup_database()
+    port = start_poll_server()
+
+class PollTest(unittest.TestCase):
+    def setUp(self):
+        clear_database()
+        self.data_versions = functions.data_versions
+
+    def tearDown(self):
+        functions.data_versions = self.data_versions
+
+    def wait(self, query):
+        conn = httplib.HTTPConnection('127.0.0.1', port, timeout=10)
+        try:
+            conn.request('GET', '/?' + query)
+            return json.loads(conn.getresponse().read())
+        finally:
+            conn.close()
+
+    def test_without_uid(self):
+        version = functions.data_version(None)
+        functions.end_request()
+        timer = threading.Timer(0.2, lambda: functions.startActivity(name='coding'))
+        timer.start()
+        response = self.wait('since_version=%d&timeout=5' % version)
+        timer.join()
+        self.assertEqual(result(response)['changed'], True)
+        self.assertTrue(result(response)['version'] > version)
+
+    def test_invalid_token(self):
+        response = self.wait('token=1.1.forged&timeout=1')
+        self.assertEqual(response['result']['msg'], 'Invalid token')
+
+    def test_failed_check(self):
+        def locked(uids):
+            raise Exception('database is locked')
+        functions.data_versions = locked
+        response = self.wait('since_version=%d&timeout=5' % functions.data_version(None))
+        self.assertTrue(response['error'])
+        self.assertEqual(response['result']['msg'], 'database is locked')
+        # The loop goes on.
+        functions.data_versions = self.data_versions
+        self.assertEqual(result(self.wait('since_version=1000&timeout=1'))['changed'], False)
+
+if __name__ == '__main__':
+    unittest.main()
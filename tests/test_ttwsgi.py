@@ -0,0 +1,82 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import csv
+import unittest
+from StringIO import StringIO
+
+from support import functions, setup_database, clear_database, result
+import simplejson as json
+import ttwsgi
+
+def get(query, **environ):
+    """Run a GET request through the WSGI application, returning its
+    status, headers and body."""
+    environ = dict({'REQUEST_METHOD': 'GET', 'QUERY_STRING': query,
+                    'wsgi.input': StringIO(''), 'SERVER_NAME': 'localhost',
+                    'wsgi.url_scheme': 'http'}, **environ)
+    started = []
+    body = ttwsgi.application(environ, lambda status, headers: started.append((status, headers)))
+    try:
+        return started[0][0], dict(started[0][1]), ''.join(body)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        setup_database()
+        clear_database()
+        self.uid = result(functions.addUser(uname='alice', pwd='secret'))['uid']
+        self.token = result(functions.authUser(uname='alice', pwd='secret'))['token']
+        for uid, name in ((self.uid, 'work'), (None, 'coding')):
+            result(functions.startActivity(uid=uid, name=name))
+            result(functions.stopActivity(uid=uid, descr=name))
+
+    def test_token(self):
+        status, headers, body = get('method=exportLogs&format=jsonl&token=%s' % self.token)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual([json.loads(line)['activity'] for line in body.splitlines()],
+                         ['work'])
+
+    def test_invalid_token(self):
+        status, headers, body = get('method=exportLogs&format=jsonl&token=%d.1.forged' % self.uid)
+        response = json.loads(body)
+        self.assertTrue(response['error'])
+        self.assertEqual(response['result']['msg'], 'Invalid token')
+
+    def test_csv_nulls(self):
+        result(functions.startActivity(uid=self.uid, name='reading'))
+        result(functions.stopActivity(uid=self.uid))
+        functions.engine.execute("UPDATE activitylog SET date_start = NULL "
+                                 "WHERE description = 'work'")
+        status, headers, body = get('method=exportLogs&token=%s' % self.token)
+        rows = list(csv.reader(body.splitlines()))
+        self.assertEqual([row[1:4] for row in rows[1:]],
+                         [['work', 'work', ''], ['reading', '', rows[2][3]]])
+        self.assertTrue(rows[2][3])
+        self.assertFalse('None' in body)
+
+class PollRedirectTest(unittest.TestCase):
+    def setUp(self):
+        setup_database()
+        self.saved = ttwsgi.poll_port, ttwsgi.poll_url
+        ttwsgi.poll_port = 8081
+
+    def tearDown(self):
+        ttwsgi.poll_port, ttwsgi.poll_url = self.saved
+
+    def test_scheme_and_host(self):
+        status, headers, body = get('method=waitForChange&since_version=3',
+                                    HTTP_HOST='example.com:8443', **{'wsgi.url_scheme': 'https'})
+        self.assertEqual(status, '307 Temporary Redirect')
+        self.assertEqual(headers['Location'],
+                         'https://example.com:8081/?method=waitForChange&since_version=3')
+
+    def test_poll_url(self):
+        ttwsgi.poll_url = 'https://example.com/poll/'
+        status, headers, body = get('method=waitForChange', HTTP_HOST='example.com')
+        self.assertEqual(headers['Location'], 'https://example.com/poll/?method=waitForChange')
+
+if __name__ == '__main__':
+    unittest.main()